@@ -111,6 +111,24 @@ class WithCacheI18n(metaclass=MetadataBase):
         use_cache = True
         use_i18n = True
 
+class WithPrerender(metaclass=MetadataBase):
+    title       = Tag(head=True, populate_from=Literal("1234"))
+    keywords    = KeywordTag()
+    description = MetaTag(populate_from="title")
+    raw1        = Raw()
+
+    class Meta:
+        use_prerender = True
+
+class WithHeadTable(metaclass=MetadataBase):
+    title    = Tag(head=True, populate_from=Literal("1234"))
+    subtitle = Tag(head=True)
+
+    class Meta:
+        use_head_table = True
+        backends = ('path', 'modelinstance', 'model')
+        seo_models = ('userapp.product', )
+
 class WithBackends(metaclass=MetadataBase):
     title    = Tag()
 
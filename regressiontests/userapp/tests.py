@@ -34,9 +34,13 @@
         - verbose_name(_plural): this is passed onto Django
 
 """
-import StringIO
+import functools
+from hashlib import md5
 
-from django.core.urlresolvers import reverse
+try:
+    from django.urls import reverse, NoReverseMatch
+except ImportError:
+    from django.core.urlresolvers import reverse, NoReverseMatch
 from django.test import TestCase
 try:
     from django.test import TransactionTestCase
@@ -47,19 +51,44 @@ from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
 from django.contrib.redirects.models import Redirect
 from django.contrib.auth.models import User
+from django.apps import apps
 from django.conf import settings
+from django.conf.urls import url
 from django.db import IntegrityError, transaction
 from django.core.handlers.wsgi import WSGIRequest
-from django.template import Template, RequestContext, TemplateSyntaxError
+from django.template import Template, Context, RequestContext, TemplateSyntaxError
 from django.core.cache import cache
-from django.utils.hashcompat import md5_constructor
 from django.utils.encoding import iri_to_uri
+from django.utils import timezone
 from django.core.management import call_command
-
-from rollyourown.seo import get_metadata as seo_get_metadata
-from rollyourown.seo.base import registry
+from asgiref.sync import async_to_sync
+
+from rollyourown.seo.base import get_metadata as seo_get_metadata
+from rollyourown.seo import base, management
+from rollyourown.seo.base import get_metadata_many as seo_get_metadata_many
+from rollyourown.seo.caching import LocalCache
+from rollyourown.seo.backends import _get_template, _resolve, SimpleTemplate, _filter_many
+from rollyourown.seo.utils import resolve_to_name, _resolve_to_name, compile_valid_tags, aget_current_site, aget_content_type
+from rollyourown.seo.fields import VALID_INLINE_TAGS
+from rollyourown.seo.models import PopulationCheckpoint
+from rollyourown.seo.management import defer_population
+from rollyourown.seo.base import registry, start_request_memo, end_request_memo, warm_metadata_cache, invalidate_metadata_cache
+from rollyourown.seo.base import aget_metadata, aget_linked_metadata, get_linked_metadata, prefetch_metadata, populate_metadata
 from userapp.models import Page, Product, Category, NoPath, Tag
-from userapp.seo import Coverage, WithSites, WithI18n, WithRedirect, WithRedirectSites, WithCache, WithCacheSites, WithCacheI18n, WithBackends
+from userapp.views import my_view, product_detail
+from userapp.seo import Coverage, WithSites, WithI18n, WithRedirect, WithRedirectSites, WithCache, WithCacheSites, WithCacheI18n, WithBackends, WithPrerender, WithHeadTable
+
+try:
+    unicode
+except NameError:
+    unicode = str
+
+
+class UnnamedUrls(object):
+    urlpatterns = [
+        url(r'^partial/(.+)/', functools.partial(my_view)),
+        url(r'^products/(\d+)/', product_detail, name="product"),
+    ]
 
 
 def get_metadata(path):
@@ -142,6 +171,99 @@ class DataSelection(TestCase):
         path_metadata.delete()
         self.assertEqual(get_metadata(path).title.value, 'View title')
 
+    def test_single_query(self):
+        """ Checks that the instances from every backend are found in a single query. """
+        path = self.product.get_absolute_url()
+        metadata = get_metadata(path)
+        self.assertNumQueries(1, lambda: metadata.title)
+        self.assertEqual(metadata.title.value, 'ModelInstance title')
+        self.assertEqual(metadata.keywords.value, 'ModelInstance keywords')
+
+    def test_metadata_many(self):
+        """ Checks that the metadata for many paths is looked up in bulk,
+            with the same results as get_metadata().
+        """
+        paths = [self.product.get_absolute_url(), self.page.get_absolute_url(), "/path/", "/does/not/exist/"]
+        # One query for each backend, and one for each model of linked objects
+        with self.assertNumQueries(6):
+            metadata = seo_get_metadata_many(paths, name="Coverage")
+        self.assertEqual(list(metadata), paths)
+        for path in paths:
+            self.assertEqual(unicode(metadata[path]), unicode(get_metadata(path)))
+        self.assertEqual(metadata[self.product.get_absolute_url()].title.value, 'ModelInstance title')
+
+    def test_metadata_many_case_insensitive(self):
+        """ Checks that bulk lookups cope with databases that compare
+            paths case insensitively (eg MySQL).
+        """
+        queryset = Coverage._meta.get_model('path').objects.all()
+
+        class CaseInsensitiveQuerySet(object):
+            def filter(self, _path__in):
+                return queryset.filter(_path__in=[path.lower() for path in _path__in])
+
+        found = _filter_many(CaseInsensitiveQuerySet(), '_path', ["/PATH/", "/path/", "/other/"])
+        self.assertEqual(found, {"/PATH/": [self.path_metadata], "/path/": [self.path_metadata], "/other/": []})
+        found = _filter_many(CaseInsensitiveQuerySet(), '_path', ["/PATH/", "/other/"])
+        self.assertEqual(found, {"/PATH/": [self.path_metadata], "/other/": []})
+
+    def test_prefetch_metadata(self):
+        """ Checks that the metadata linked from a list of objects is
+            fetched with a query for each content type.
+        """
+        products = [self.product, Product.objects.create(), Product.objects.create()]
+        expected = [unicode(get_linked_metadata(p, name="Coverage")) for p in products]
+        # One query for the model instance metadata, one for the model metadata
+        self.assertNumQueries(2, lambda: prefetch_metadata(products, name="Coverage"))
+        self.assertNumQueries(0, lambda: [unicode(get_linked_metadata(p, name="Coverage")) for p in products])
+        self.assertEqual([unicode(get_linked_metadata(p, name="Coverage")) for p in products], expected)
+
+    def test_request_memo(self):
+        """ Checks that metadata is only looked up once per request. """
+        path = self.product.get_absolute_url()
+        self.assertNotEqual(get_metadata(path), get_metadata(path))
+        previous = start_request_memo()
+        try:
+            metadata = get_metadata(path)
+            self.assertEqual(metadata.title.value, 'ModelInstance title')
+            self.assertNumQueries(0, lambda: get_metadata(path).title)
+            self.assertTrue(get_metadata(path) is metadata)
+        finally:
+            end_request_memo(previous)
+        self.assertFalse(get_metadata(path) is metadata)
+
+    def test_async(self):
+        """ Checks that the async API finds the same metadata, and that
+            it is memoized for later synchronous lookups.
+        """
+        path = self.product.get_absolute_url()
+        metadata = async_to_sync(aget_metadata)(path, name="Coverage")
+        self.assertEqual(metadata.title.value, 'ModelInstance title')
+        self.assertEqual(unicode(metadata), unicode(get_metadata(path)))
+        linked = async_to_sync(aget_linked_metadata)(self.product, name="Coverage")
+        self.assertEqual(unicode(linked), unicode(get_linked_metadata(self.product, name="Coverage")))
+        previous = start_request_memo()
+        try:
+            metadata = async_to_sync(aget_metadata)(path, name="Coverage")
+            self.assertNumQueries(0, lambda: unicode(get_metadata(path)))
+            self.assertTrue(get_metadata(path) is metadata)
+        finally:
+            end_request_memo(previous)
+
+    def test_async_cached_lookups(self):
+        """ Checks that sites and content types can be looked up from async
+            code, using Django's caches once they have been looked up.
+        """
+        Site.objects.clear_cache()
+        ContentType.objects.clear_cache()
+        site = async_to_sync(aget_current_site)()
+        content_type = async_to_sync(aget_content_type)(Product)
+        self.assertEqual(site, Site.objects.get_current())
+        self.assertEqual(content_type, ContentType.objects.get_for_model(Product))
+        self.assertNumQueries(0, lambda: async_to_sync(aget_current_site)())
+        self.assertNumQueries(0, lambda: async_to_sync(aget_content_type)(Product))
+        self.assertNumQueries(0, lambda: async_to_sync(aget_content_type)(id=content_type.id))
+
     def test_sites(self):
         """ Tests the django.contrib.sites support.
             A separate metadata definition is used, WithSites, which has turned on sites support.
@@ -251,7 +373,6 @@ class DataSelection(TestCase):
         """ Tests that the system gracefully handles a developer error 
             (eg exception in get_absolute_url).
         """
-        from django.core.urlresolvers import NoReverseMatch
         try:
             self.page.type = "a type with spaces!" # this causes get_absolute_url() to fail
             self.page.save()
@@ -270,7 +391,7 @@ class DataSelection(TestCase):
             self.page.save()
             Coverage._meta.get_model('modelinstance').objects.get(_content_type=self.page_content_type, _object_id=self.page.id).delete()
             self.page.delete()
-        except Exception, e:
+        except Exception as e:
             self.fail("Exception raised inappropriately: %r" % e)
 
     def test_path_change(self):
@@ -442,6 +563,29 @@ class ValueResolution(TestCase):
         self.assertEqual(self.context1.description.value, u'MMD Description for MD Page One Title and MD Page One Title')
         self.assertEqual(self.context2.description.value, u'MMD Description for Page two content. and Page two content.')
 
+    def test_template_cache(self):
+        """ Checks that substituted values are only parsed once. """
+        _get_template.cache_clear()
+        self.assertEqual(get_metadata(path=self.page1.get_absolute_url()).description.value, u'MMD Description for MD Page One Title and MD Page One Title')
+        self.assertEqual(get_metadata(path=self.page2.get_absolute_url()).description.value, u'MMD Description for Page two content. and Page two content.')
+        info = _get_template.cache_info()
+        self.assertEqual(info.misses, 1)
+        self.assertTrue(info.hits >= 1)
+
+    def test_simple_substitution(self):
+        """ Checks that values with only variables are rendered without the
+            template engine, with the same output.
+        """
+        engine = Template('').engine
+        self.assertTrue(isinstance(_get_template(u"{{ page.title }} | {{ page.type }}", engine), SimpleTemplate))
+        self.assertFalse(isinstance(_get_template(u"{{ page.title|upper }}", engine), SimpleTemplate))
+        self.assertFalse(isinstance(_get_template(u"{% if page %}{{ page }}{% endif %}", engine), SimpleTemplate))
+        self.page1.title = u"<b>Tom & Jerry</b>"
+        for value in (u"{{ page.title }} | {{ page.type }}", u"{{ page.missing }}{{ page }}", u"MMD { Title",
+                      u"{{ True }} {{ False }} {{ None }}"):
+            context = Context({'page': self.page1})
+            self.assertEqual(_resolve(value, self.page1), Template(value).render(context))
+
     def test_view_variable_substitution(self):
         """ Simple check to see if view variable substitution is happening """
         response = self.client.get(reverse('userapp_my_view', args=["abc123"]))
@@ -449,6 +593,15 @@ class ValueResolution(TestCase):
         self.assertContains(response, u'<meta name="keywords" content="MD abc123 Keywords" />')
         self.assertContains(response, u'<meta name="hs:metatag" content="MD abc123 Description" />')
 
+    def test_view_name(self):
+        """ Checks that a known view name is used instead of resolving the path. """
+        path = "/does/not/resolve/"
+        self.assertEqual(get_metadata(path=path).title.value, u"example.com")
+        self.assertEqual(seo_get_metadata(path, name="Coverage", view_name="userapp_my_view").title.value, u'MD  Title')
+        # The view metadata is found from the ResolverMatch left by Django
+        response = self.client.get(reverse('userapp_my_view', args=["abc123"]))
+        self.assertEqual(seo_get_metadata(path, name="Coverage", view_name=response.resolver_match).title.value, u'MD  Title')
+
     def test_not_request_context(self):
         """ Tests the view metadata on a view that is not a request context. """
         self.view_metadata._view = "userapp_my_other_view"
@@ -560,6 +713,16 @@ class Formatting(TestCase):
         exp = '<title>%s</title>' % exp
         self.assertEqual(unicode(metadata.title), exp)
 
+    def test_compiled_valid_tags(self):
+        """ Checks that the valid tags are compiled once for each field,
+            and shared between fields with the same valid tags.
+        """
+        title = Coverage._meta.elements['title']
+        self.assertEqual(title.compiled_valid_tags, compile_valid_tags(VALID_INLINE_TAGS))
+        self.assertTrue(compile_valid_tags(["b", "i"]) is compile_valid_tags(set(["i", "b"])))
+        tag_re = compile_valid_tags([])
+        self.assertTrue(compile_valid_tags(tag_re) is tag_re)
+
     def test_raw1(self):
         """ Tests that raw fields in head are cleaned correctly. 
         """
@@ -600,8 +763,8 @@ class Definition(TransactionTestCase):
     """
 
     def test_backends(self):
-        self.assertEqual(Coverage._meta.models.keys(), ['path', 'modelinstance', 'model', 'view'])
-        self.assertEqual(WithBackends._meta.models.keys(), ['view', 'path'])
+        self.assertEqual(list(Coverage._meta.models.keys()), ['path', 'modelinstance', 'model', 'view'])
+        self.assertEqual(list(WithBackends._meta.models.keys()), ['view', 'path'])
 
     def test_help_text_direct(self):
         self.assert_help_text('help_text1', "Some help text 1.")
@@ -646,6 +809,35 @@ class Definition(TransactionTestCase):
         except IntegrityError:
             transaction.rollback()
 
+    def test_update_on_commit(self):
+        " Checks that objects saved in a transaction are updated once it is committed. "
+        Metadata = Coverage._meta.get_model('modelinstance')
+        content_type = ContentType.objects.get_for_model(Product)
+        base.SEO_UPDATE_ON_COMMIT = True
+        try:
+            with transaction.atomic():
+                product = Product.objects.create()
+                product.save()
+                self.assertFalse(Metadata.objects.filter(_content_type=content_type, _object_id=product.pk).exists())
+                deleted = Product.objects.create()
+                deleted.delete()
+            metadata = Metadata.objects.get(_content_type=content_type, _object_id=product.pk)
+            self.assertEqual(metadata._path, product.get_absolute_url())
+            self.assertFalse(Metadata.objects.filter(_content_type=content_type, _object_id=deleted.pk).exists())
+
+            try:
+                with transaction.atomic():
+                    Product.objects.create()
+                    raise ValueError
+            except ValueError:
+                pass
+            # Objects are still collected after a transaction is rolled back
+            with transaction.atomic():
+                other = Product.objects.create()
+            self.assertTrue(Metadata.objects.filter(_content_type=content_type, _object_id=other.pk).exists())
+        finally:
+            base.SEO_UPDATE_ON_COMMIT = False
+
 
 class MetaOptions(TestCase):
     """ Meta options (System tests)
@@ -654,6 +846,8 @@ class MetaOptions(TestCase):
         + use_i18n:
         + use_redirect:
         + use_cache:
+        + use_prerender:
+        + use_head_table:
         + seo_models: list of models and/or apps which are available for model instance metadata
         + seo_views: list of models and/or apps which are available for model instance metadata
         - verbose_name(_plural): this is passed onto Django
@@ -666,14 +860,16 @@ class MetaOptions(TestCase):
         """
         if 'dummy' not in settings.CACHE_BACKEND:
             path = '/'
-            hexpath = md5_constructor(iri_to_uri(path)).hexdigest() 
+            hexpath = md5(iri_to_uri(path).encode('utf-8')).hexdigest() 
+            WithCache._meta.get_model('path').objects.create(_path=path)
 
             #unicode(seo_get_metadata(path, name="Coverage"))
             unicode(seo_get_metadata(path, name="WithCache"))
 
-            self.assertEqual(cache.get('rollyourown.seo.Coverage.%s.title' % hexpath), None)
-            self.assertEqual(cache.get('rollyourown.seo.WithCache.%s.title' % hexpath), "1234")
-            self.assertEqual(cache.get('rollyourown.seo.WithCache.%s.subtitle' % hexpath), "")
+            record = cache.get('rollyourown.seo.WithCache.%s' % hexpath)
+            self.assertEqual(cache.get('rollyourown.seo.Coverage.%s' % hexpath), None)
+            self.assertEqual(record['values']['title'], "1234")
+            self.assertEqual(record['values']['subtitle'], "")
 
     def test_use_cache_site(self):
         """ Checks that the cache plays nicely with sites.
@@ -681,29 +877,226 @@ class MetaOptions(TestCase):
         if 'dummy' not in settings.CACHE_BACKEND:
             path = '/'
             site = Site.objects.get_current()
-            hexpath = md5_constructor(iri_to_uri(site.domain+path)).hexdigest()
+            hexpath = md5(iri_to_uri(site.domain+path).encode('utf-8')).hexdigest()
+            WithCacheSites._meta.get_model('path').objects.create(_path=path, _site=site)
 
             #unicode(seo_get_metadata(path, name="Coverage"))
             unicode(seo_get_metadata(path, name="WithCacheSites", site=site))
 
-            self.assertEqual(cache.get('rollyourown.seo.Coverage.%s.title' % hexpath), None)
-            self.assertEqual(cache.get('rollyourown.seo.WithCacheSites.%s.title' % hexpath), "1234")
-            self.assertEqual(cache.get('rollyourown.seo.WithCacheSites.%s.subtitle' % hexpath), "")
+            record = cache.get('rollyourown.seo.WithCacheSites.%s' % hexpath)
+            self.assertEqual(cache.get('rollyourown.seo.Coverage.%s' % hexpath), None)
+            self.assertEqual(record['values']['title'], "1234")
+            self.assertEqual(record['values']['subtitle'], "")
 
     def test_use_cache_i18n(self):
         """ Checks that the cache plays nicely with i18n. 
         """
         if 'dummy' not in settings.CACHE_BACKEND:
             path = '/'
-            hexpath = md5_constructor(iri_to_uri(path)).hexdigest()
+            hexpath = md5(iri_to_uri(path).encode('utf-8')).hexdigest()
+            WithCacheI18n._meta.get_model('path').objects.create(_path=path, _language='de')
 
             #unicode(seo_get_metadata(path, name="Coverage"))
             unicode(seo_get_metadata(path, name="WithCacheI18n", language='de'))
 
-            self.assertEqual(cache.get('rollyourown.seo.Coverage.%s.de.title' % hexpath), None)
-            self.assertEqual(cache.get('rollyourown.seo.WithCacheI18n.%s.en.title' % hexpath), None)
-            self.assertEqual(cache.get('rollyourown.seo.WithCacheI18n.%s.de.title' % hexpath), "1234")
-            self.assertEqual(cache.get('rollyourown.seo.WithCacheI18n.%s.de.subtitle' % hexpath), "")
+            record = cache.get('rollyourown.seo.WithCacheI18n.%s.de' % hexpath)
+            self.assertEqual(cache.get('rollyourown.seo.Coverage.%s.de' % hexpath), None)
+            self.assertEqual(cache.get('rollyourown.seo.WithCacheI18n.%s.en' % hexpath), None)
+            self.assertEqual(record['values']['title'], "1234")
+            self.assertEqual(record['values']['subtitle'], "")
+
+    def test_use_cache_single_entry(self):
+        """ Checks that all fields, groups and the head are read from a single cache entry.
+        """
+        if 'dummy' not in settings.CACHE_BACKEND:
+            path = '/'
+            hexpath = md5(iri_to_uri(path).encode('utf-8')).hexdigest()
+            WithCache._meta.get_model('path').objects.create(_path=path)
+            unicode(seo_get_metadata(path, name="WithCache"))
+
+            record = cache.get('rollyourown.seo.WithCache.%s' % hexpath)
+            self.assertEqual(record['head'], "<title>1234</title>\n")
+            record['values']['title'] = "5678"
+            cache.set('rollyourown.seo.WithCache.%s' % hexpath, record)
+            metadata = seo_get_metadata(path, name="WithCache")
+            self.assertEqual(metadata.title.value, "5678")
+            self.assertEqual(metadata.subtitle.value, None)
+
+    def test_use_cache_empty(self):
+        """ Checks that paths without metadata are cached as a marker, without any values.
+        """
+        if 'dummy' not in settings.CACHE_BACKEND:
+            path = '/empty/'
+            hexpath = md5(iri_to_uri(path).encode('utf-8')).hexdigest()
+            self.assertEqual(unicode(seo_get_metadata(path, name="WithCache")), "<title>1234</title>\n")
+            record = cache.get('rollyourown.seo.WithCache.%s' % hexpath)
+            self.assertTrue(record['empty'])
+            self.assertFalse('values' in record)
+            self.assertNumQueries(0, lambda: unicode(seo_get_metadata(path, name="WithCache")))
+            self.assertEqual(seo_get_metadata(path, name="WithCache").title.value, "1234")
+
+            # Adding metadata for the path replaces the marker
+            WithCache._meta.get_model('path').objects.create(_path=path, subtitle="Subtitle")
+            self.assertEqual(seo_get_metadata(path, name="WithCache").subtitle.value, "Subtitle")
+
+    def test_use_cache_invalidation(self):
+        """ Checks that cached metadata is removed when the metadata changes.
+        """
+        if 'dummy' not in settings.CACHE_BACKEND:
+            path = '/invalidation/'
+            self.assertEqual(seo_get_metadata(path, name="WithCache").title.value, "1234")
+
+            path_md = WithCache._meta.get_model('path').objects.create(_path=path, title="Path title")
+            self.assertEqual(seo_get_metadata(path, name="WithCache").title.value, "Path title")
+
+            # Changes to other backends can affect any path
+            view_md = WithCache._meta.get_model('view').objects.create(_view="userapp_my_view", title="View title")
+            self.assertEqual(seo_get_metadata('/my/view/text/', name="WithCache").title.value, "View title")
+            view_md.title = "New view title"
+            view_md.save()
+            self.assertEqual(seo_get_metadata('/my/view/text/', name="WithCache").title.value, "New view title")
+
+            # Moving an entry removes the metadata cached for its previous path
+            for new_path in ('/invalidation/moved/', '/invalidation/moved/again/'):
+                old_path, path_md._path = path_md._path, new_path
+                path_md.save()
+                self.assertEqual(seo_get_metadata(old_path, name="WithCache").title.value, "1234")
+                self.assertEqual(seo_get_metadata(new_path, name="WithCache").title.value, "Path title")
+
+            path_md.delete()
+            self.assertEqual(seo_get_metadata(path_md._path, name="WithCache").title.value, "1234")
+
+    def test_use_cache_generations(self):
+        """ Checks that all cached metadata for a definition or a site can be made stale at once.
+        """
+        if 'dummy' not in settings.CACHE_BACKEND:
+            path = '/generations/'
+            site = Site.objects.get_current()
+            WithCache._meta.get_model('path').objects.create(_path=path, title="Old title")
+            WithCacheSites._meta.get_model('path').objects.create(_path=path, title="Old title", _site=site)
+            self.assertEqual(seo_get_metadata(path, name="WithCache").title.value, "Old title")
+            self.assertEqual(seo_get_metadata(path, name="WithCacheSites", site=site).title.value, "Old title")
+
+            # Updates do not send signals, so the cache is not invalidated
+            WithCache._meta.get_model('path').objects.update(title="New title")
+            WithCacheSites._meta.get_model('path').objects.update(title="New title")
+            self.assertEqual(seo_get_metadata(path, name="WithCache").title.value, "Old title")
+
+            invalidate_metadata_cache("WithCache")
+            self.assertEqual(seo_get_metadata(path, name="WithCache").title.value, "New title")
+            self.assertEqual(seo_get_metadata(path, name="WithCacheSites", site=site).title.value, "Old title")
+
+            call_command('clear_metadata_cache', site=site.domain)
+            self.assertEqual(seo_get_metadata(path, name="WithCacheSites", site=site).title.value, "New title")
+
+    def test_local_cache(self):
+        """ Checks the bounds of the in-process cache used in front of the cache backend.
+        """
+        local_cache = LocalCache(max_entries=2)
+        local_cache.set('a', 1)
+        local_cache.set('b', 2)
+        local_cache.get('a')
+        local_cache.set('c', 3)
+        self.assertEqual(local_cache.get('a'), 1)
+        self.assertEqual(local_cache.get('b'), None)
+        self.assertEqual(local_cache.get('c'), 3)
+
+        local_cache = LocalCache(max_bytes=100)
+        local_cache.set('a', "x" * 40)
+        local_cache.set('b', "y" * 40)
+        self.assertEqual(local_cache.get('a'), None)
+        self.assertEqual(local_cache.get('b'), "y" * 40)
+
+        local_cache = LocalCache(max_entries=2, timeout=-1)
+        local_cache.set('a', 1)
+        self.assertEqual(local_cache.get('a'), None)
+
+    def test_use_cache_stampede(self):
+        """ Checks that only one process rebuilds an expired record, while others use the old one.
+        """
+        if 'dummy' not in settings.CACHE_BACKEND:
+            path = '/stampede/'
+            hexpath = md5(iri_to_uri(path).encode('utf-8')).hexdigest()
+            cache_key = 'rollyourown.seo.WithCache.%s' % hexpath
+            path_md = WithCache._meta.get_model('path').objects.create(_path=path, title="Old title")
+            unicode(seo_get_metadata(path, name="WithCache"))
+            WithCache._meta.get_model('path').objects.update(title="New title")
+
+            # Expire the record, as if its timeout had passed
+            record = cache.get(cache_key)
+            record['expires'] = 0
+            cache.set(cache_key, record)
+
+            # Another process is rebuilding the record, the old one is used
+            cache.add('%s.lock' % cache_key, 1)
+            self.assertEqual(seo_get_metadata(path, name="WithCache").title.value, "Old title")
+
+            cache.delete('%s.lock' % cache_key)
+            self.assertEqual(seo_get_metadata(path, name="WithCache").title.value, "New title")
+
+    def test_warm_cache(self):
+        """ Checks that the cache can be filled for a number of paths at once.
+        """
+        if 'dummy' not in settings.CACHE_BACKEND:
+            paths = ['/warm/1/', '/warm/2/']
+            warm_metadata_cache(paths, name="WithCache")
+            for path in paths:
+                hexpath = md5(iri_to_uri(path).encode('utf-8')).hexdigest()
+                record = cache.get('rollyourown.seo.WithCache.%s' % hexpath)
+                self.assertTrue(record['empty'])
+
+    def test_use_prerender(self):
+        """ Checks that the cleaned values are stored when saved, and used
+            rather than cleaning the values again.
+        """
+        Metadata = WithPrerender._meta.get_model('path')
+        metadata = Metadata.objects.create(_path='/', title='A <b>title</b> & more', raw1='x <meta name="a" content="b" /> y')
+        metadata = Metadata.objects.get(pk=metadata.pk)
+        self.assertEqual(metadata._title_html, 'A <b>title</b> &amp; more')
+        self.assertEqual(metadata._raw1_html, '<meta name="a" content="b" />')
+        self.assertEqual(metadata._keywords_html, None)
+
+        Metadata.objects.filter(pk=metadata.pk).update(_title_html='Stored title')
+        self.assertEqual(seo_get_metadata('/', name="WithPrerender").title.value, 'Stored title')
+
+        # Values that may have substitutions are still resolved when used
+        metadata.title = '{{ title }}'
+        metadata.save(update_fields=['title'])
+        self.assertEqual(Metadata.objects.get(pk=metadata.pk)._title_html, None)
+
+        # Fields populated from a stored value clean it themselves
+        Metadata.objects.create(_path='/populated/', title='A <b class="x" onclick="y()">"b"</b>\nc')
+        metadata = seo_get_metadata('/populated/', name="WithPrerender")
+        self.assertEqual(metadata.description.value,
+                         'A &lt;b class=&quot;x&quot; onclick=&quot;y()&quot;&gt;&quot;b&quot;&lt;/b&gt; c')
+
+    def test_use_head_table(self):
+        """ Checks that the head table is kept up to date, and used to
+            look up the metadata with a single query.
+        """
+        Head = WithHeadTable._meta.head_model
+        path_md = WithHeadTable._meta.get_model('path').objects.create(_path='/head/', subtitle='A & B')
+        product = Product.objects.create()
+        self.assertEqual(sorted(Head.objects.values_list('_path', flat=True)), ['/head/', product.get_absolute_url()])
+
+        with self.assertNumQueries(1):
+            metadata = seo_get_metadata('/head/', name="WithHeadTable")
+            self.assertEqual(unicode(metadata), '<title>1234</title>\n<subtitle>A &amp; B</subtitle>')
+        with self.assertNumQueries(1):
+            metadata = seo_get_metadata('/missing/', name="WithHeadTable")
+            self.assertEqual(metadata.title.value, '1234')
+
+        # The row for the previous path is removed each time an entry is moved
+        for old_path, new_path in (('/head/', '/head2/'), ('/head2/', '/head3/')):
+            path_md._path = new_path
+            path_md.save()
+            self.assertEqual(seo_get_metadata(new_path, name="WithHeadTable").subtitle.value, 'A &amp; B')
+            self.assertEqual(seo_get_metadata(old_path, name="WithHeadTable").subtitle.value, None)
+        self.assertEqual(sorted(Head.objects.values_list('_path', flat=True)), ['/head3/', product.get_absolute_url()])
+
+        Head.objects.all().delete()
+        call_command('rebuild_metadata_heads', 'WithHeadTable', verbosity=0)
+        self.assertEqual(sorted(Head.objects.values_list('_path', flat=True)), ['/head3/', product.get_absolute_url()])
 
 
 class Templates(TestCase):
@@ -885,8 +1278,8 @@ class Templates(TestCase):
         """ Deregister any alternative metadata classes for the sake of testing. 
             This emulates the situation where there is only one metadata definition.
         """
-        self._previous_registry = registry.items()
-        for key in registry.keys():
+        self._previous_registry = list(registry.items())
+        for key in list(registry.keys()):
             del registry[key]
         registry['Coverage'] = Coverage
 
@@ -913,6 +1306,8 @@ class Random(TestCase):
         self.model_metadata = self.Metadata.objects.get(_content_type=self.content_type,
                                                     _object_id=self.page.id)
         self.context = get_metadata(path=self.model_metadata._path)
+        # Population deferred when the test database was migrated
+        PopulationCheckpoint.objects.all().delete()
 
     def test_default_fallback(self):
         """ Tests the ability to use the current Site name as a default 
@@ -927,11 +1322,25 @@ class Random(TestCase):
         num_metadata = self.Metadata.objects.all().count()
         try:
             no_path = NoPath.objects.create()
-        except Exception, e:
+        except Exception as e:
             self.fail("Exception inappropriately raised: %r" % e)
         new_num_metadata = self.Metadata.objects.all().count()
         self.assertEqual(num_metadata, new_num_metadata)
 
+    def test_resolve_to_name(self):
+        " Checks that paths are resolved to view names, and that these are remembered. "
+        _resolve_to_name.cache_clear()
+        self.assertEqual(resolve_to_name("/pages/abc/"), "userapp_page_detail")
+        self.assertEqual(resolve_to_name("/my/other/view/abc/"), "userapp_my_other_view")
+        self.assertEqual(resolve_to_name("/does/not/exist/"), None)
+        self.assertEqual(resolve_to_name("/pages/abc/"), "userapp_page_detail")
+        self.assertEqual(_resolve_to_name.cache_info().hits, 1)
+
+    def test_resolve_to_name_unnamed(self):
+        " Checks that unnamed views without a __name__ can be resolved, and don't affect other paths. "
+        self.assertEqual(resolve_to_name("/partial/abc/", urlconf=UnnamedUrls), "functools.partial")
+        self.assertEqual(resolve_to_name("/products/1/", urlconf=UnnamedUrls), "product")
+
     def test_syncdb_populate(self):
         " Checks that syncdb populates the seo metadata. "
         Metadata = Coverage._meta.get_model('modelinstance')
@@ -959,7 +1368,7 @@ class Random(TestCase):
         try:
             for sql in sql_list:
                 cursor.execute(sql)
-        except Exception, e:
+        except Exception as e:
             transaction.rollback_unless_managed()
 
     def test_management_populate(self):
@@ -982,6 +1391,131 @@ class Random(TestCase):
         if full_metadata < existing_metadata:
             self.fail("No metadata objects created.")
 
+    def test_populate_metadata_chunks(self):
+        " Checks that populate_metadata creates missing metadata in chunks, as saving each object would. "
+        Metadata = Coverage._meta.get_model('modelinstance')
+        content_type = ContentType.objects.get_for_model(Product)
+        products = [Product.objects.create() for i in range(5)]
+        Metadata.objects.filter(_content_type=content_type).delete()
+        # An outdated entry for another product is holding this product's path
+        metadata = Metadata.objects.create(_content_type=content_type, _object_id=products[1].pk)
+        Metadata.objects.filter(pk=metadata.pk).update(_path=products[0].get_absolute_url())
+
+        progress = []
+        populate_metadata(Product, Metadata, chunk_size=2, progress=lambda processed, total: progress.append((processed, total)))
+        self.assertEqual(progress, [(2, 5), (4, 5), (5, 5)])
+        for product in products:
+            metadata = Metadata.objects.get(_content_type=content_type, _object_id=product.pk)
+            self.assertEqual(metadata._path, product.get_absolute_url())
+
+    def test_populate_metadata_resume(self):
+        " Checks that an interrupted populate_metadata run is resumed from its checkpoint. "
+        Metadata = Coverage._meta.get_model('modelinstance')
+        content_type = ContentType.objects.get_for_model(Product)
+        products = [Product.objects.create() for i in range(3)]
+        Metadata.objects.filter(_content_type=content_type).delete()
+        PopulationCheckpoint.objects.create(metadata="Coverage", model=Product._meta.label,
+                                            started=timezone.now(), last_pk=products[0].pk)
+
+        call_command('populate_metadata', verbosity=0)
+        object_ids = Metadata.objects.filter(_content_type=content_type).values_list('_object_id', flat=True)
+        self.assertEqual(sorted(object_ids), [product.pk for product in products[1:]])
+
+        # The run is complete, so the next one starts from the beginning
+        call_command('populate_metadata', verbosity=0)
+        self.assertEqual(Metadata.objects.filter(_content_type=content_type).count(), 3)
+
+    def test_populate_metadata_pending(self):
+        " Checks that population deferred when migrating is done by populate_metadata --pending. "
+        Metadata = Coverage._meta.get_model('modelinstance')
+        content_type = ContentType.objects.get_for_model(Product)
+        product = Product.objects.create()
+        Metadata.objects.filter(_content_type=content_type).delete()
+
+        call_command('populate_metadata', pending=True, verbosity=0)
+        self.assertFalse(Metadata.objects.filter(_content_type=content_type).exists())
+
+        defer_population(Coverage, Product)
+        call_command('populate_metadata', pending=True, verbosity=0)
+        self.assertEqual(Metadata.objects.get(_content_type=content_type)._object_id, product.pk)
+
+    def test_migrate_defers_population(self):
+        " Checks that migrating only records the population of models without metadata, by default. "
+        Metadata = Coverage._meta.get_model('modelinstance')
+        content_type = ContentType.objects.get_for_model(Product)
+        Product.objects.create()
+        Metadata.objects.filter(_content_type=content_type).delete()
+
+        management._syncdb_handler(apps.get_app_config('seo'), verbosity=0)
+        self.assertFalse(Metadata.objects.filter(_content_type=content_type).exists())
+        checkpoint = PopulationCheckpoint.objects.get(metadata="Coverage", model=Product._meta.label)
+        self.assertNotEqual(checkpoint.started, None)
+
+    def test_populate_metadata_workers(self):
+        " Checks that ranges populated in parallel are merged in order, with their conflicts resolved by the command. "
+        Metadata = Coverage._meta.get_model('modelinstance')
+        content_type = ContentType.objects.get_for_model(Product)
+        products = [Product.objects.create() for i in range(25)]
+        Metadata.objects.filter(_content_type=content_type).delete()
+        # Outdated entries holding the paths of products in other ranges
+        for product, other in ((products[0], products[22]), (products[12], products[3])):
+            metadata = Metadata.objects.create(_content_type=content_type, _object_id=product.pk)
+            Metadata.objects.filter(pk=metadata.pk).update(_path=other.get_absolute_url())
+
+        def progress(Metadata, model, processed, total):
+            if (Metadata, model) == (Coverage, Product):
+                checkpoint = PopulationCheckpoint.objects.get(metadata="Coverage", model=Product._meta.label)
+                checkpoints.append((processed, total, checkpoint.last_pk))
+
+        tasks = []
+        checkpoints = []
+        original = management.multiprocessing, management.connections
+        management.multiprocessing, management.connections = InProcessMultiprocessing(tasks), NoConnections()
+        try:
+            management.populate_all_metadata(chunk_size=1, progress=progress, workers=2)
+        finally:
+            management.multiprocessing, management.connections = original
+
+        # The last range is done first, but is only recorded once those before it are
+        ranges = [pk_range for key, pk_range, chunk_size, since in tasks if key == ("Coverage", Product._meta.label)]
+        self.assertEqual(ranges, [(products[20].pk, products[24].pk), (products[10].pk, products[19].pk),
+                                  (products[0].pk, products[9].pk)])
+        self.assertEqual(checkpoints, [(5, 25, None), (15, 25, None), (25, 25, products[24].pk)])
+        self.assertEqual(Metadata.objects.filter(_content_type=content_type).count(), len(products))
+        for product in products:
+            metadata = Metadata.objects.get(_content_type=content_type, _object_id=product.pk)
+            self.assertEqual(metadata._path, product.get_absolute_url())
+        checkpoint = PopulationCheckpoint.objects.get(metadata="Coverage", model=Product._meta.label)
+        self.assertEqual((checkpoint.started, checkpoint.last_pk), (None, None))
+
+
+class InProcessMultiprocessing(object):
+    """ Stands in for the multiprocessing module, running the tasks given
+        to a pool in this process, the last ones first.
+    """
+    def __init__(self, tasks):
+        self.tasks = tasks
+
+    def Pool(self, processes, initializer=None):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def imap_unordered(self, func, tasks):
+        for task in reversed(list(tasks)):
+            self.tasks.append(task)
+            yield func(task)
+
+
+class NoConnections(object):
+    """ Keeps the test database connection open while populating in parallel. """
+    def close_all(self):
+        pass
+
 
 class Admin(TestCase):
 
@@ -998,7 +1532,7 @@ class Admin(TestCase):
         path = '/admin/userapp/page/add/'
         try:
             response = self.client.get(path)
-        except Exception, e:
+        except Exception as e:
             self.fail(u"Exception raised at '%s': %s" % (path, e))
         self.assertEqual(response.status_code, 200)
 
@@ -1017,7 +1551,7 @@ class Admin(TestCase):
 
         try:
             response = self.client.post(path, data, follow=True)
-        except Exception, e:
+        except Exception as e:
             raise
             self.fail(u"Exception raised at '%s': %s" % (path, e))
         self.assertEqual(response.status_code, 200)
@@ -1048,7 +1582,7 @@ class Admin(TestCase):
             path = '/alt-admin/userapp/%s/add/' % model
             try:
                 response = self.client.get(path)
-            except Exception, e:
+            except Exception as e:
                 self.fail(u"Exception raised at '%s': %s" % (path, e))
             self.assertContains(response, "seo-coveragemodelinstance-_content_type", status_code=200)
             self.assertNotContains(response, "seo-withsitesmodelinstance-_content_type")
@@ -1063,7 +1597,7 @@ class Admin(TestCase):
 
         try:
             response = self.client.post(path, data, follow=True)
-        except Exception, e:
+        except Exception as e:
             raise
             self.fail(u"Exception raised at '%s': %s" % (path, e))
         self.assertEqual(response.status_code, 200)
@@ -1,5 +1,4 @@
 from django.apps.config import AppConfig
-from rollyourown.seo.models import setup
 
 
 class SeoConfig(AppConfig):
@@ -7,4 +6,5 @@ class SeoConfig(AppConfig):
     verbose_name = 'django-seo'
 
     def ready(self):
+        from rollyourown.seo.models import setup
         setup()
@@ -1,25 +1,34 @@
 #!/usr/bin/env python
+import copy
+import re
 from collections import OrderedDict
+from functools import lru_cache
 
 from django.utils.translation import ugettext_lazy as _
 from django.conf import settings
 from django.db import models
+from django.db.models import F, Value, IntegerField, prefetch_related_objects
 from django.contrib.sites.models import Site
 from django.contrib.contenttypes.models import ContentType
 try:
     from django.contrib.contenttypes.fields import GenericForeignKey
 except ImportError:
     from django.contrib.contenttypes.generic import GenericForeignKey
-from django.template import Template, Context
+from django.template import Template, Context, Engine, Variable, VariableDoesNotExist
+from django.template.base import Lexer, TokenType, render_value_in_context
+from django.utils.safestring import mark_safe
 from django.utils import six
 
-from rollyourown.seo.utils import resolve_to_name, NotSet, Literal
+from rollyourown.seo.utils import resolve_to_name, NotSet, Literal, aget_content_type, alist
+from rollyourown.seo.fields import CleanedValue
 
 RESERVED_FIELD_NAMES = ('_metadata', '_path', '_content_type', '_object_id',
                         '_content_object', '_view', '_site', 'objects',
                         '_resolve_value', '_set_context', 'id', 'pk' )
 
 SEO_PATH_FIELD_MAX_LENGTH = getattr(settings, 'SEO_PATH_FIELD_MAX_LENGTH', 255)
+SEO_BULK_CHUNK_SIZE = getattr(settings, 'SEO_BULK_CHUNK_SIZE', 500)
+SEO_TEMPLATE_CACHE_SIZE = getattr(settings, 'SEO_TEMPLATE_CACHE_SIZE', 1000)
 
 backend_registry = OrderedDict()
 
@@ -35,9 +44,45 @@ class MetadataBaseModel(models.Model):
         # TODO Rename to __metadata
         self._metadata = self.__class__._metadata()
 
+        # Remember the path as it was loaded or last saved, so that a change can be detected
+        self._loaded_path = self.__dict__.get('_path')
+
+    def save(self, *args, **kwargs):
+        # Store the cleaned value of each field, so it need not be cleaned when used
+        prerendered = self._metadata._meta.prerendered
+        update_fields = kwargs.get('update_fields')
+        if prerendered and update_fields is not None:
+            update_fields = kwargs['update_fields'] = list(update_fields)
+            update_fields.extend([prerendered[name] for name in update_fields if name in prerendered])
+        for name, attname in prerendered.items():
+            if update_fields is None or attname in update_fields:
+                setattr(self, attname, self._prerender(name))
+        super(MetadataBaseModel, self).save(*args, **kwargs)
+        if update_fields is None or '_path' in update_fields:
+            self._loaded_path = self.__dict__.get('_path')
+
+    def _prerender(self, name):
+        """ Returns the cleaned value to store for the given field, or None
+            if it must be resolved when used (eg it may have substitutions).
+        """
+        value = getattr(self, name)
+        if value and '{' not in value:
+            return self._metadata._meta.elements[name].clean(value) or None
+
+    async def _aprefetch(self):
+        """ Fetches the related objects needed to resolve values, so that
+            this instance can be used from an async context.
+        """
+        if getattr(self, '_content_type_id', None) is not None:
+            self._content_type = await aget_content_type(id=self._content_type_id)
+
     # TODO Rename to __resolve_value?
-    def _resolve_value(self, name):
-        """ Returns an appropriate value for the given name. """
+    def _resolve_value(self, name, prerendered=True):
+        """ Returns an appropriate value for the given name.
+            A value stored already cleaned (see Meta.use_prerender) is only
+            used if prerendered is True, ie when name is the field being
+            output, as each field cleans the values it is populated from.
+        """
         name = str(name)
         if name in self._metadata._meta.elements:
             element = self._metadata._meta.elements[name]
@@ -46,6 +91,9 @@ class MetadataBaseModel(models.Model):
             if element.editable:
                 value = getattr(self, name)
                 if value:
+                    attname = self._metadata._meta.prerendered.get(name)
+                    if prerendered and attname is not None and getattr(self, attname) is not None:
+                        return CleanedValue(getattr(self, attname))
                     return value
 
             # Otherwise, return an appropriate default value (populate_from)
@@ -55,7 +103,7 @@ class MetadataBaseModel(models.Model):
             elif isinstance(populate_from, Literal):
                 return populate_from.value
             elif populate_from is not NotSet:
-                return self._resolve_value(populate_from)
+                return self._resolve_value(populate_from, prerendered=False)
 
         # If this is not an element, look for an attribute on metadata
         try:
@@ -140,12 +188,22 @@ class MetadataBackend(six.with_metaclass(MetadataBackendBase)):
 
     def get_manager(self, options):
         _get_instances = self.get_instances
+        _get_resolution_queryset = self.get_resolution_queryset
+        _get_instances_many = self.get_instances_many
 
         class _Manager(BaseManager):
             def get_instances(self, path, site=None, language=None, context=None):
                 queryset = self.for_site_and_language(site, language)
                 return _get_instances(queryset, path, context)
 
+            def get_resolution_queryset(self, path, site=None, language=None, querysets=None, context=None):
+                queryset = self.for_site_and_language(site, language)
+                return _get_resolution_queryset(queryset, path, querysets or {}, context or {})
+
+            def get_instances_many(self, paths, site=None, language=None, instances=None):
+                queryset = self.for_site_and_language(site, language)
+                return _get_instances_many(queryset, paths, instances or {})
+
             if not options.use_sites:
                 def for_site_and_language(self, site=None, language=None):
                     queryset = self.get_queryset()
@@ -154,6 +212,29 @@ class MetadataBackend(six.with_metaclass(MetadataBackendBase)):
                     return queryset
         return _Manager
 
+    def get_resolution_queryset(self, queryset, path, querysets, context):
+        """ Returns a queryset of candidate instances, which can be combined
+            with those of the other backends into a single query.
+            querysets holds the querysets of the preceding backends, by name.
+        """
+        return self.get_instances(queryset, path, context)
+
+    def get_instances_many(self, queryset, paths, instances):
+        """ Returns a dict of the candidate instances for each of the given
+            paths, for looking up the metadata of many paths at once.
+            instances holds the results of the preceding backends, by name.
+        """
+        results = {}
+        for path in paths:
+            results[path] = list(self.get_instances(queryset, path, {}) or [])
+        return results
+
+    def get_cached_paths(self, instance):
+        """ Returns the paths whose cached metadata may depend on the given
+            instance, or None if any path may depend on it.
+        """
+        return None
+
 
     @staticmethod
     def validate(options):
@@ -169,6 +250,12 @@ class PathBackend(MetadataBackend):
     def get_instances(self, queryset, path, context):
         return queryset.filter(_path=path)
 
+    def get_instances_many(self, queryset, paths, instances):
+        return _filter_many(queryset, '_path', paths)
+
+    def get_cached_paths(self, instance):
+        return set(p for p in (instance._path, instance._loaded_path) if p)
+
     def get_model(self, options):
         class PathMetadataBase(MetadataBaseModel):
             _path = models.CharField(_('path'), max_length=SEO_PATH_FIELD_MAX_LENGTH, unique=not (options.use_sites or options.use_i18n))
@@ -197,11 +284,17 @@ class ViewBackend(MetadataBackend):
     unique_together = (("_view",),)
 
     def get_instances(self, queryset, path, context):
-        view_name = ""
-        if path is not None:
+        # Use the view name if it is already known (eg from request.resolver_match)
+        view_name = context.get('view_name') if context else None
+        if view_name is None and path is not None:
             view_name = resolve_to_name(path)
         return queryset.filter(_view=view_name or "")
 
+    def get_instances_many(self, queryset, paths, instances):
+        view_names = dict((path, resolve_to_name(path) or "") for path in paths)
+        found = _filter_many(queryset, '_view', set(view_names.values()))
+        return dict((path, found[view_name]) for path, view_name in view_names.items())
+
     def get_model(self, options):
         class ViewMetadataBase(MetadataBaseModel):
             _view = models.CharField(_('view'), max_length=255, unique=not (options.use_sites or options.use_i18n), default="", blank=True)
@@ -219,8 +312,8 @@ class ViewBackend(MetadataBackend):
             def _populate_from_kwargs(self):
                 return {'view_name': self._view}
 
-            def _resolve_value(self, name):
-                value = super(ViewMetadataBase, self)._resolve_value(name)
+            def _resolve_value(self, name, prerendered=True):
+                value = super(ViewMetadataBase, self)._resolve_value(name, prerendered)
                 try:
                     return _resolve(value, context=self.__context)
                 except AttributeError:
@@ -244,6 +337,15 @@ class ModelInstanceBackend(MetadataBackend):
     def get_instances(self, queryset, path, context):
         return queryset.filter(_path=path)
 
+    def get_instances_many(self, queryset, paths, instances):
+        found = _filter_many(queryset, '_path', paths)
+        # Fetch the objects used for substitutions with a query per model
+        prefetch_related_objects([i for l in found.values() for i in l], '_content_object')
+        return found
+
+    def get_cached_paths(self, instance):
+        return set(p for p in (instance._path, instance._loaded_path) if p)
+
     def get_model(self, options):
         class ModelInstanceMetadataBase(MetadataBaseModel):
             _path = models.CharField(_('path'), max_length=SEO_PATH_FIELD_MAX_LENGTH, editable=False, unique=not (options.use_sites or options.use_i18n))
@@ -264,12 +366,21 @@ class ModelInstanceBackend(MetadataBackend):
                 abstract = True
 
             def _process_context(self, context):
-                context['content_type'] = self._content_type
+                context['content_type'] = ContentType.objects.get_for_id(self._content_type_id)
                 context['model_instance'] = self
 
             def _populate_from_kwargs(self):
                 return {'model_instance': self._content_object}
 
+            async def _aprefetch(self):
+                await super(ModelInstanceMetadataBase, self)._aprefetch()
+                field = self._meta.get_field('_content_object')
+                model = self._content_type.model_class()
+                if model is not None and not field.is_cached(self):
+                    queryset = model._base_manager.using(self._state.db).filter(pk=self._object_id)
+                    for obj in await alist(queryset):
+                        field.set_cached_value(self, obj)
+
             def save(self, *args, **kwargs):
                 try:
                     path_func = self._content_object.get_absolute_url
@@ -291,6 +402,23 @@ class ModelBackend(MetadataBackend):
         if context and 'content_type' in context:
             return queryset.filter(_content_type=context['content_type'])
 
+    def get_resolution_queryset(self, queryset, path, querysets, context):
+        # The content type comes from the model instance metadata for this
+        # path, so select it in a subquery rather than waiting for the instance.
+        if querysets.get('modelinstance') is not None:
+            content_types = querysets['modelinstance'].values('_content_type')
+            return queryset.filter(_content_type__in=content_types)
+
+    def get_instances_many(self, queryset, paths, instances):
+        # The content types come from the model instance metadata found for each path
+        content_types = {}
+        for path in paths:
+            content_types[path] = set(i._content_type_id for i in instances.get('modelinstance', {}).get(path, []))
+        found = _filter_many(queryset, '_content_type_id', set().union(*content_types.values()))
+        # Each path needs its own copies, as they are given the model instance to use for substitutions
+        return dict((path, sorted((copy.copy(i) for ct in cts for i in found[ct]), key=lambda i: i.pk))
+                    for path, cts in content_types.items())
+
     def get_model(self, options):
         class ModelMetadataBase(MetadataBaseModel):
             _content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
@@ -313,8 +441,8 @@ class ModelBackend(MetadataBackend):
             def _populate_from_kwargs(self):
                 return {'content_type': self._content_type}
 
-            def _resolve_value(self, name):
-                value = super(ModelMetadataBase, self)._resolve_value(name)
+            def _resolve_value(self, name, prerendered=True):
+                value = super(ModelMetadataBase, self)._resolve_value(name, prerendered)
                 try:
                     return _resolve(value, self.__instance._content_object)
                 except AttributeError:
@@ -336,16 +464,182 @@ class ModelBackend(MetadataBackend):
             raise Exception("Metadata backend 'modelinstance' must be installed in order to use 'model' backend")
 
 
+def _filter_many(queryset, attname, values):
+    """ Returns a dict of the instances in the queryset whose attname
+        matches each of the given values, using an __in query for each
+        chunk of SEO_BULK_CHUNK_SIZE values.
+    """
+    values = list(values)
+    results = dict((value, []) for value in values)
+    for i in range(0, len(values), SEO_BULK_CHUNK_SIZE):
+        chunk = values[i:i + SEO_BULK_CHUNK_SIZE]
+        # Some databases compare strings case insensitively (eg MySQL's
+        # default collations), so a row is given to every value that
+        # matches it ignoring case, as a lookup of each value would be
+        folded = {}
+        for value in chunk:
+            key = value.lower() if isinstance(value, str) else value
+            folded.setdefault(key, []).append(value)
+        for instance in queryset.filter(**{'%s__in' % attname: chunk}).order_by('pk'):
+            value = getattr(instance, attname)
+            key = value.lower() if isinstance(value, str) else value
+            for match in folded.get(key, []):
+                results[match].append(instance)
+    return results
+
+
+def _get_combined_queryset(querysets):
+    """ Combines the querysets of several backend models into a single
+        UNION ALL query, ordered by the precedence of each backend (ie the
+        order of querysets). Returns the combined queryset and a function
+        to build an instance from each of its rows.
+    """
+    querysets = [(qs.model, qs) for qs in querysets if qs is not None]
+    if not querysets:
+        return None, None
+
+    # Every branch must select the same columns, so take the union of all
+    # the concrete fields and select NULL where a model lacks one.
+    columns = OrderedDict()
+    for model, queryset in querysets:
+        for field in model._meta.concrete_fields:
+            columns.setdefault(field.attname, field)
+
+    combined = []
+    for precedence, (model, queryset) in enumerate(querysets):
+        attnames = set(f.attname for f in model._meta.concrete_fields)
+        annotations = OrderedDict([('_seo_precedence', Value(precedence, output_field=IntegerField()))])
+        for attname, field in columns.items():
+            if attname in attnames:
+                annotations['_seo_%s' % attname] = F(attname)
+            else:
+                annotations['_seo_%s' % attname] = Value(None, output_field=field)
+        combined.append(queryset.order_by().annotate(**annotations).values_list(*annotations))
+
+    pk_alias = '_seo_%s' % querysets[0][0]._meta.pk.attname
+    queryset = combined[0].union(*combined[1:], all=True).order_by('_seo_precedence', pk_alias)
+    index = dict((attname, i + 1) for i, attname in enumerate(columns))
+
+    def from_row(row):
+        model = querysets[row[0]][0]
+        values = [row[index[f.attname]] for f in model._meta.concrete_fields]
+        return model.from_db(queryset.db, [f.attname for f in model._meta.concrete_fields], values)
+
+    return queryset, from_row
+
+
+def combine_querysets(querysets):
+    """ Yields the instances of the given backend querysets, in order of
+        precedence, fetched in a single query.
+    """
+    queryset, from_row = _get_combined_queryset(querysets)
+    if queryset is not None:
+        for row in queryset:
+            yield from_row(row)
+
+
+async def acombine_querysets(querysets):
+    """ Async counterpart of combine_querysets(), returning a list. """
+    queryset, from_row = _get_combined_queryset(querysets)
+    if queryset is None:
+        return []
+    return [from_row(row) for row in await alist(queryset)]
+
 
 def _resolve(value, model_instance=None, context=None):
     """ Resolves any template references in the given value.
     """
 
     if isinstance(value, six.string_types) and "{" in value:
+        template = _get_template(value, Engine.get_default())
+        variables = {}
+        if model_instance is not None:
+            variables[model_instance._meta.model_name] = model_instance
+        if context is None and isinstance(template, SimpleTemplate):
+            return template.render_variables(variables)
         if context is None:
             context = Context()
-        if model_instance is not None:
-            context[model_instance._meta.module_name] = model_instance
-        value = Template(value).render(context)
+        for name, variable in variables.items():
+            context[name] = variable
+        value = template.render(context)
     return value
 
+
+@lru_cache(maxsize=SEO_TEMPLATE_CACHE_SIZE)
+def _get_template(source, engine):
+    """ Returns the compiled template for the given source.
+        The same few values are substituted over and over again, so the
+        most recently used templates are kept rather than parsed each time.
+    """
+    parts = []
+    for token in Lexer(source).tokenize():
+        if token.token_type == TokenType.TEXT:
+            parts.append(token.contents)
+        elif token.token_type == TokenType.VAR and SIMPLE_VARIABLE_RE.match(token.contents.strip()):
+            parts.append(Variable(token.contents.strip()))
+        else:
+            # Tags, filters and comments need the full template engine
+            return Template(source, engine=engine)
+    return SimpleTemplate(parts, engine)
+
+
+SIMPLE_VARIABLE_RE = re.compile(r'^[A-Za-z]\w*(\.[A-Za-z0-9]\w*)*$')
+
+
+class SimpleTemplate(object):
+    """ A template with nothing but text and plain variable lookups, such
+        as "{{ product.name }} | Shop", which is rendered by resolving each
+        variable directly, giving the same output as the equivalent Template.
+    """
+    name = None
+
+    def __init__(self, parts, engine):
+        self.parts = parts
+        self.engine = engine
+
+    def render_variables(self, variables):
+        """ Renders the template with the given variables, without the
+            overhead of creating a Context.
+        """
+        return self._render(_VariableContext(self, variables))
+
+    def render(self, context):
+        with context.render_context.push_state(self):
+            if context.template is None:
+                with context.bind_template(self):
+                    return self._render(context)
+            return self._render(context)
+
+    def _render(self, context):
+        output = []
+        for part in self.parts:
+            if isinstance(part, Variable):
+                try:
+                    value = part.resolve(context)
+                except VariableDoesNotExist:
+                    value = context.template.engine.string_if_invalid
+                    if '%s' in value:
+                        value = value % part
+                part = render_value_in_context(value, context)
+            output.append(part)
+        return mark_safe(''.join(output))
+
+
+class _VariableContext(object):
+    """ Just enough of a default Context to resolve and render variables. """
+    autoescape = True
+    use_l10n = None
+    use_tz = None
+    # The variables every Context starts with
+    builtins = {'True': True, 'False': False, 'None': None}
+
+    def __init__(self, template, variables):
+        self.template = template
+        self._variables = variables
+
+    def __getitem__(self, key):
+        try:
+            return self._variables[key]
+        except KeyError:
+            return self.builtins[key]
+
@@ -2,44 +2,53 @@
 #    * Move/rename namespace polluting attributes
 #    * Documentation
 #    * Make backends optional: Meta.backends = (path, modelinstance/model, view)
-import hashlib
 from collections import OrderedDict
 
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
 from django.utils.functional import curry
 from django.contrib.contenttypes.models import ContentType
 from django.utils.safestring import mark_safe
-from django.core.cache import cache
-from django.utils.encoding import iri_to_uri
 
-from rollyourown.seo.utils import NotSet, Literal
+from rollyourown.seo import caching, materialized
+from rollyourown.seo.utils import NotSet, Literal, aget, aget_current_site, aget_content_type, get_view_name, chunked
 from rollyourown.seo.options import Options
-from rollyourown.seo.fields import MetadataField
-from rollyourown.seo.backends import backend_registry, RESERVED_FIELD_NAMES
-from django.utils import six
+from rollyourown.seo.fields import MetadataField, CleanedValue
+from rollyourown.seo.backends import backend_registry, combine_querysets, acombine_querysets, RESERVED_FIELD_NAMES
+from rollyourown.seo.backends import _filter_many, SEO_BULK_CHUNK_SIZE
+try:
+    from asgiref.local import Local
+except ImportError:
+    from threading import local as Local
 
 registry = OrderedDict()
 
+# Holds the metadata memo for the current request (see MetadataMiddleware)
+_request_local = Local()
+
+# Holds the objects saved in the current transaction on each database (see SEO_UPDATE_ON_COMMIT)
+_pending_local = Local()
+
+SEO_UPDATE_ON_COMMIT = getattr(settings, 'SEO_UPDATE_ON_COMMIT', False)
+
 
 class FormattedMetadata(object):
     """ Allows convenient access to selected metadata.
         Metadata for each field may be sourced from any one of the relevant instances passed.
+        If caching is enabled, every field, group and the head output for the path are
+        cached together as a single record. Paths without any metadata instances are
+        cached as a small marker, and their default values are resolved when needed.
+        The same records are used when they are loaded from the head table.
     """
 
     def __init__(self, metadata, instances, path, site=None, language=None):
         self.__metadata = metadata
-        if metadata._meta.use_cache:
-            if metadata._meta.use_sites and site:
-                hexpath = hashlib.md5(iri_to_uri(site.domain + path)).hexdigest()
-            else:
-                hexpath = hashlib.md5(iri_to_uri(path).encode('utf-8')).hexdigest()
-            if metadata._meta.use_i18n:
-                self.__cache_prefix = 'rollyourown.seo.%s.%s.%s' % \
-                                      (self.__metadata.__class__.__name__, hexpath, language)
-            else:
-                self.__cache_prefix = 'rollyourown.seo.%s.%s' % (self.__metadata.__class__.__name__, hexpath)
+        if metadata._meta.use_cache and path:
+            self._cache_key = caching.get_cache_key(metadata.__class__, path, site, language)
         else:
-            self.__cache_prefix = None
+            self._cache_key = None
+        self.__site = site
+        self.__cache_record = None
         self.__instances_original = instances
         self.__instances_cache = []
 
@@ -54,12 +63,12 @@ class FormattedMetadata(object):
             self.__instances_cache.append(instance)
             yield instance
 
-    def _resolve_value(self, name):
+    def _resolve_value(self, name, prerendered=True):
         """ Returns an appropriate value for the given name.
             This simply asks each of the instances for a value.
         """
         for instance in self.__instances():
-            value = instance._resolve_value(name)
+            value = instance._resolve_value(name, prerendered)
             if value:
                 return value
 
@@ -72,85 +81,91 @@ class FormattedMetadata(object):
             elif isinstance(populate_from, Literal):
                 return populate_from.value
             elif populate_from is not NotSet:
-                return self._resolve_value(populate_from)
+                return self._resolve_value(populate_from, prerendered=False)
 
-    def __getattr__(self, name):
-        # If caching is enabled, work out a key
-        if self.__cache_prefix:
-            cache_key = '%s.%s' % (self.__cache_prefix, name)
-            value = cache.get(cache_key)
-        else:
-            cache_key = None
-            value = None
+    def _render_plan(self, plan, values):
+        """ Returns the html output of the fields in the given plan
+            (see Options.head_plan), one per line.
+        """
+        output = []
+        for name, clean, render in plan:
+            value = values[name]
+            if value and not isinstance(value, CleanedValue):
+                value = clean(value)
+            output.append(render(value) if value else '')
+        return '\n'.join(output)
+
+    def _build_cache_record(self):
+        """ Resolves every field, group and the head output, ready to be
+            stored in the cache as a single entry.
+        """
+        meta = self.__metadata._meta
+        empty = not any(True for instance in self.__instances())
+        values = dict((name, self._resolve_value(name) or '') for name in meta.elements)
+        groups = dict((name, self._render_plan(plan, values).strip())
+                      for name, plan in meta.group_plans.items())
+        head = self._render_plan(meta.head_plan, values)
+        return {'values': values, 'groups': groups, 'head': head, 'empty': empty}
+
+    def _load_cache_record(self, record):
+        """ Uses the given record (from the cache) for this path.
+            Returns False if there is no record to use.
+        """
+        if record is None:
+            return False
+        if 'values' not in record:
+            # There are no instances for this path, only defaults
+            self.__instances_original = []
+            record = self._build_cache_record()
+        self.__cache_record = record
+        return True
+
+    def _use_record(self):
+        return self._cache_key is not None or self.__cache_record is not None
+
+    def __get_cache_record(self):
+        """ Returns the cached record for this path, building it (and
+            storing it in the cache) if it is missing.
+        """
+        if self.__cache_record is None:
+            metadata_class = self.__metadata.__class__
+            record, generation = caching.get_record(metadata_class, self._cache_key, self.__site)
+            if not self._load_cache_record(record):
+                record = self._build_cache_record()
+                caching.set_records(metadata_class, {self._cache_key: record}, generation)
+                self.__cache_record = record
+        return self.__cache_record
 
+    def __getattr__(self, name):
         # Look for a group called "name"
         if name in self.__metadata._meta.groups:
-            if value is not None:
-                value = mark_safe(value)
-                return value or None
-            value_list = []
-            for f in self.__metadata._meta.groups[name]:
-                try:
-                    v = six.u(BoundMetadataField(self.__metadata._meta.elements[f], self._resolve_value(f)))
-                except NameError:
-                    v = str(BoundMetadataField(self.__metadata._meta.elements[f], self._resolve_value(f)))
-                value_list.append(v)
-            value = '\n'.join(value_list).strip()
-
-            if value is not None:
-                value = mark_safe(value)
+            if self._use_record():
+                value = self.__get_cache_record()['groups'][name]
+            else:
+                plan = self.__metadata._meta.group_plans[name]
+                values = dict((f, self._resolve_value(f)) for f, clean, render in plan)
+                value = self._render_plan(plan, values).strip()
+            return mark_safe(value) or None
 
         # Look for an element called "name"
         elif name in self.__metadata._meta.elements:
-            if value is not None:
-                value = mark_safe(value)
-                return BoundMetadataField(self.__metadata._meta.elements[name], value or None)
-            value = self._resolve_value(name)
-            if cache_key is not None:
-                cache.set(cache_key, value or '')
-
-            if value is not None:
-                value = mark_safe(value)
+            if self._use_record():
+                value = self.__get_cache_record()['values'][name] or None
+            else:
+                value = self._resolve_value(name)
 
             return BoundMetadataField(self.__metadata._meta.elements[name], value)
         else:
             raise AttributeError
 
-        if cache_key is not None:
-            cache.set(cache_key, value or '')
-
-        if value is not None:
-            value = mark_safe(value)
-
-        return value or None
-
     def __str__(self):
         """ String version of this object is the html output of head elements. """
-        if self.__cache_prefix is not None:
-            value = cache.get(self.__cache_prefix)
-        else:
-            value = None
-
-        if value is None:
-            # workaround
-            # AttributeError: 'BoundMetadataField' object has no attribute 'replace'
-            # value = '\n'.join(six.u(getattr(self, f)) for f, e in self.__metadata._meta.elements.items() if e.head)
-            value = []
-            for f, e in self.__metadata._meta.elements.items():
-                if e.head:
-                    attr = getattr(self, f)
-                    if six.PY3:
-                        value.append(attr.__str__())
-                    else:
-                        value.append(attr.__unicode__())
-
-            value = '\n'.join(value)
-
-            value = mark_safe(value)
-            if self.__cache_prefix is not None:
-                cache.set(self.__cache_prefix, value or '')
+        if self._use_record():
+            return mark_safe(self.__get_cache_record()['head'])
 
-        return value
+        plan = self.__metadata._meta.head_plan
+        values = dict((f, self._resolve_value(f)) for f, clean, render in plan)
+        return mark_safe(self._render_plan(plan, values))
 
 
 class BoundMetadataField(object):
@@ -158,7 +173,9 @@ class BoundMetadataField(object):
 
     def __init__(self, field, value):
         self.field = field
-        if value:
+        if isinstance(value, CleanedValue):
+            self.value = value
+        elif value:
             self.value = field.clean(value)
         else:
             self.value = None
@@ -238,28 +255,142 @@ class MetadataBase(type):
         except KeyError:
             raise Exception('Metadata backend "%s" is not installed.' % backend_name)
 
+        if options.use_head_table:
+            options._add_head_model()
+
         registry[name] = new_class
 
         return new_class
 
     # TODO: Move this function out of the way (subclasses will want to define their own attributes)
-    def _get_formatted_data(cls, path, context=None, site=None, language=None):
+    def _get_formatted_data(cls, path, context=None, site=None, language=None, view_name=None):
         """ Return an object to conveniently access the appropriate values. """
-        return FormattedMetadata(cls(), cls._get_instances(path, context, site, language), path, site, language)
+        if cls._meta.use_head_table and path:
+            formatted = FormattedMetadata(cls(), [], path, site, language)
+            formatted._load_cache_record(materialized.get_record(cls, path, site, language))
+            return formatted
+        instances = cls._get_instances(path, context, site, language, view_name)
+        return FormattedMetadata(cls(), instances, path, site, language)
 
     # TODO: Move this function out of the way (subclasses will want to define their own attributes)
-    def _get_instances(cls, path, context=None, site=None, language=None):
+    def _get_instances(cls, path, context=None, site=None, language=None, view_name=None):
         """ A sequence of instances to discover metadata.
-            Each instance from each backend is looked up when possible/necessary.
-            This is a generator to eliminate unnecessary queries.
+            The candidate instances from every backend are fetched in a
+            single query, in order of backend precedence.
+            This is a generator, so no query is made until a value is needed.
         """
         backend_context = {'view_context': context}
+        querysets = cls._get_resolution_querysets(path, site, language, view_name)
+        for instance in combine_querysets(querysets.values()):
+            if hasattr(instance, '_process_context'):
+                instance._process_context(backend_context)
+            yield instance
 
-        for model in cls._meta.models.values():
-            for instance in model.objects.get_instances(path, site, language, backend_context) or []:
+    def _get_formatted_data_many(cls, paths, context=None, site=None, language=None):
+        """ Returns a dict of objects to access the values for each of the
+            given paths. Cached records are fetched together, and any missing
+            records are built from instances fetched in bulk and stored together.
+        """
+        results = OrderedDict((path, FormattedMetadata(cls(), [], path, site, language)) for path in paths)
+        if cls._meta.use_head_table:
+            records = materialized.get_records(cls, paths, site, language)
+            for path, formatted in results.items():
+                formatted._load_cache_record(records[path])
+            return results
+
+        missing = list(results)
+        if cls._meta.use_cache:
+            keys = [formatted._cache_key for formatted in results.values() if formatted._cache_key is not None]
+            records, generation = caching.get_records(cls, keys, site)
+            missing = [path for path, formatted in results.items()
+                       if not formatted._load_cache_record(records.get(formatted._cache_key))]
+
+        new_records = {}
+        for path, instances in cls._get_instances_many(missing, context, site, language).items():
+            formatted = results[path] = FormattedMetadata(cls(), instances, path, site, language)
+            if formatted._cache_key is not None:
+                record = new_records[formatted._cache_key] = formatted._build_cache_record()
+                formatted._load_cache_record(record)
+        if new_records:
+            caching.set_records(cls, new_records, generation)
+        return results
+
+    def _get_instances_many(cls, paths, context=None, site=None, language=None):
+        """ Returns a dict of the instances to discover metadata for each
+            of the given paths, with a few queries for each backend.
+        """
+        found = OrderedDict()
+        for name, model in cls._meta.models.items():
+            found[name] = model.objects.get_instances_many(paths, site, language, found)
+
+        results = OrderedDict()
+        for path in paths:
+            backend_context = {'view_context': context}
+            results[path] = [instance for instances in found.values() for instance in instances[path]]
+            for instance in results[path]:
                 if hasattr(instance, '_process_context'):
                     instance._process_context(backend_context)
-                yield instance
+        return results
+
+    def _refresh_head_table(cls, paths):
+        """ Rebuilds the rows of the head table for the given paths (any
+            iterable), on every site and in every language, in chunks.
+        """
+        sites_and_languages = caching.get_sites_and_languages(cls)
+        for chunk in chunked(paths, SEO_BULK_CHUNK_SIZE):
+            chunk = list(OrderedDict.fromkeys(path for path in chunk if path))
+            records = {}
+            for site, language in sites_and_languages:
+                for path, instances in cls._get_instances_many(chunk, None, site, language).items():
+                    record = FormattedMetadata(cls(), instances, path, site, language)._build_cache_record()
+                    if not record['empty']:
+                        records[(path, site, language)] = record
+            materialized.set_records(cls, chunk, records)
+
+    def _get_resolution_querysets(cls, path, site=None, language=None, view_name=None):
+        context = {}
+        if view_name is not None:
+            context['view_name'] = get_view_name(view_name)
+        querysets = OrderedDict()
+        for name, model in cls._meta.models.items():
+            querysets[name] = model.objects.get_resolution_queryset(path, site, language, querysets, context)
+        return querysets
+
+    async def _aget_formatted_data(cls, path, context=None, site=None, language=None, view_name=None):
+        """ Async counterpart of _get_formatted_data().
+            All of the IO is done here, so that the returned object can be
+            used (eg in a template) without touching the database or cache.
+        """
+        if cls._meta.use_head_table and path:
+            formatted = FormattedMetadata(cls(), [], path, site, language)
+            formatted._load_cache_record(await materialized.aget_record(cls, path, site, language))
+            return formatted
+        if cls._meta.use_sites and not site:
+            site = await aget_current_site()
+        formatted = FormattedMetadata(cls(), [], path, site, language)
+        if formatted._cache_key is not None:
+            record, generation = await caching.aget_record(cls, formatted._cache_key, site)
+            if formatted._load_cache_record(record):
+                return formatted
+
+        instances = await cls._aget_instances(path, context, site, language, view_name)
+        formatted = FormattedMetadata(cls(), instances, path, site, language)
+        if formatted._cache_key is not None:
+            record = formatted._build_cache_record()
+            await caching.aset_records(cls, {formatted._cache_key: record}, generation)
+            formatted._load_cache_record(record)
+        return formatted
+
+    async def _aget_instances(cls, path, context=None, site=None, language=None, view_name=None):
+        """ Async counterpart of _get_instances(), returning a list. """
+        backend_context = {'view_context': context}
+        querysets = cls._get_resolution_querysets(path, site, language, view_name)
+        instances = await acombine_querysets(querysets.values())
+        for instance in instances:
+            await instance._aprefetch()
+            if hasattr(instance, '_process_context'):
+                instance._process_context(backend_context)
+        return instances
 
 
 # class Metadata(six.with_metaclass(MetadataBase)):
@@ -283,9 +414,133 @@ def _get_metadata_model(name=None):
         return list(registry.values())[0]
 
 
-def get_metadata(path, name=None, context=None, site=None, language=None):
+def start_request_memo():
+    """ Starts memoizing metadata lookups, until end_request_memo() is called.
+        Returns the previous memo, which should be passed to end_request_memo().
+    """
+    previous = getattr(_request_local, 'memo', None)
+    _request_local.memo = {}
+    return previous
+
+
+def end_request_memo(previous=None):
+    _request_local.memo = previous
+
+
+def _get_memo_key(metadata, path, site, language):
+    return (metadata._meta.name, path, getattr(site, 'pk', site), language)
+
+
+def _memoize(key, func, *args):
+    """ Returns func(*args), reusing the result of any previous call with
+        the same key during the current request.
+    """
+    memo = getattr(_request_local, 'memo', None)
+    if memo is None:
+        return func(*args)
+    try:
+        return memo[key]
+    except KeyError:
+        value = memo[key] = func(*args)
+        return value
+
+
+def set_request_view(path, resolver_match):
+    """ Records the view that the current request's path resolved to (see
+        MetadataMiddleware), so that it need not be resolved again.
+    """
+    memo = getattr(_request_local, 'memo', None)
+    if memo is not None:
+        memo[('view', path)] = resolver_match
+
+
+def _get_request_view(path):
+    memo = getattr(_request_local, 'memo', None)
+    if memo is not None:
+        return memo.get(('view', path))
+
+
+def get_metadata(path, name=None, context=None, site=None, language=None, view_name=None):
+    """ Returns the metadata for the given path.
+        If the name of the view for the path is already known, it can be
+        given as view_name (a name or a ResolverMatch, eg request.resolver_match)
+        to avoid resolving the path again.
+    """
+    metadata = _get_metadata_model(name)
+    key = _get_memo_key(metadata, path, site, language)
+    if view_name is None:
+        view_name = _get_request_view(path)
+    return _memoize(key, metadata._get_formatted_data, path, context, site, language, view_name)
+
+
+def get_metadata_many(paths, name=None, context=None, site=None, language=None):
+    """ Returns a dict of the metadata for each of the given paths, looked
+        up in bulk rather than path by path.
+    """
+    metadata = _get_metadata_model(name)
+    paths = list(OrderedDict.fromkeys(paths))
+    return metadata._get_formatted_data_many(paths, context, site, language)
+
+
+async def aget_metadata(path, name=None, context=None, site=None, language=None, view_name=None):
+    """ Async counterpart of get_metadata().
+        The metadata is fetched up front and memoized for the current request
+        (see MetadataMiddleware), so that later {% get_metadata %} calls for
+        the same path are answered without any IO.
+    """
+    metadata = _get_metadata_model(name)
+    key = _get_memo_key(metadata, path, site, language)
+    memo = getattr(_request_local, 'memo', None)
+    if memo is not None and key in memo:
+        return memo[key]
+    if view_name is None:
+        view_name = _get_request_view(path)
+    value = await metadata._aget_formatted_data(path, context, site, language, view_name)
+    if memo is not None:
+        memo[key] = value
+    return value
+
+
+def warm_metadata_cache(paths, name=None, site=None, language=None):
+    """ Fills the cache with the metadata for each of the given paths,
+        using a single set_many() call.
+    """
     metadata = _get_metadata_model(name)
-    return metadata._get_formatted_data(path, context, site, language)
+    paths = list(OrderedDict.fromkeys(paths))
+    generation = caching.get_generation(metadata, site)
+    records = {}
+    for path, instances in metadata._get_instances_many(paths, None, site, language).items():
+        formatted = FormattedMetadata(metadata(), instances, path, site, language)
+        if formatted._cache_key is not None:
+            records[formatted._cache_key] = formatted._build_cache_record()
+    caching.set_records(metadata, records, generation)
+
+
+def rebuild_head_table(name=None):
+    """ Rebuilds the head table for the given definition (see
+        Meta.use_head_table), in chunks of SEO_BULK_CHUNK_SIZE paths, and
+        removes the rows of paths that no longer have any metadata.
+    """
+    metadata = _get_metadata_model(name)
+    querysets = [model.objects.values_list('_path', flat=True).order_by()
+                 for backend_name, model in metadata._meta.models.items()
+                 if backend_name in ('path', 'modelinstance')]
+    if querysets:
+        metadata._refresh_head_table(querysets[0].union(*querysets[1:]).iterator())
+    stale = metadata._meta.head_model.objects.all()
+    for queryset in querysets:
+        stale = stale.exclude(_path__in=queryset)
+    stale.delete()
+
+
+def invalidate_metadata_cache(name=None, site=None):
+    """ Marks the cached metadata for the given definition (or for every
+        definition that uses sites, if a site is given) as stale.
+    """
+    if site is not None:
+        caching.invalidate_site(site)
+    else:
+        caching.invalidate_metadata(_get_metadata_model(name))
 
 
 def get_linked_metadata(obj, name=None, context=None, site=None, language=None):
@@ -295,21 +550,102 @@ def get_linked_metadata(obj, name=None, context=None, site=None, language=None):
     Metadata = _get_metadata_model(name)
     InstanceMetadata = Metadata._meta.get_model('modelinstance')
     ModelMetadata = Metadata._meta.get_model('model')
+
+    # Use any metadata fetched by prefetch_metadata()
+    instances = getattr(obj, '_seo_linked_metadata', {}).get(Metadata._meta.name)
+    if instances is not None:
+        return FormattedMetadata(Metadata(), instances, '', site, language)
+
     content_type = ContentType.objects.get_for_model(obj)
-    instances = []
+    instance_md = model_md = None
     if InstanceMetadata is not None:
         try:
             instance_md = InstanceMetadata.objects.get(_content_type=content_type, _object_id=obj.pk)
         except InstanceMetadata.DoesNotExist:
-            instance_md = InstanceMetadata(_content_object=obj)
-        instances.append(instance_md)
+            pass
     if ModelMetadata is not None:
         try:
             model_md = ModelMetadata.objects.get(_content_type=content_type)
         except ModelMetadata.DoesNotExist:
-            model_md = ModelMetadata(_content_type=content_type)
+            pass
+    instances = _get_linked_instances(Metadata, obj, content_type, instance_md, model_md)
+    return FormattedMetadata(Metadata(), instances, '', site, language)
+
+
+async def aget_linked_metadata(obj, name=None, context=None, site=None, language=None):
+    """ Async counterpart of get_linked_metadata(). """
+    Metadata = _get_metadata_model(name)
+    InstanceMetadata = Metadata._meta.get_model('modelinstance')
+    ModelMetadata = Metadata._meta.get_model('model')
+
+    instances = getattr(obj, '_seo_linked_metadata', {}).get(Metadata._meta.name)
+    if instances is not None:
+        return FormattedMetadata(Metadata(), instances, '', site, language)
+
+    content_type = await aget_content_type(obj)
+    instance_md = model_md = None
+    if InstanceMetadata is not None:
+        try:
+            instance_md = await aget(InstanceMetadata.objects.all(), _content_type=content_type, _object_id=obj.pk)
+        except InstanceMetadata.DoesNotExist:
+            pass
+    if ModelMetadata is not None:
+        try:
+            model_md = await aget(ModelMetadata.objects.all(), _content_type=content_type)
+        except ModelMetadata.DoesNotExist:
+            pass
+    instances = _get_linked_instances(Metadata, obj, content_type, instance_md, model_md)
+    return FormattedMetadata(Metadata(), instances, '', site, language)
+
+
+def _get_linked_instances(Metadata, obj, content_type, instance_md, model_md):
+    """ Returns the instances to discover metadata linked from the given
+        object, given the instances found (or None).
+    """
+    InstanceMetadata = Metadata._meta.get_model('modelinstance')
+    ModelMetadata = Metadata._meta.get_model('model')
+    instances = []
+    if InstanceMetadata is not None:
+        if instance_md is None:
+            instance_md = InstanceMetadata(_content_type=content_type, _object_id=obj.pk)
+        instance_md._meta.get_field('_content_object').set_cached_value(instance_md, obj)
+        instances.append(instance_md)
+    if ModelMetadata is not None:
+        if model_md is None:
+            model_md = ModelMetadata()
+        model_md._content_type = content_type
         instances.append(model_md)
-    return FormattedMetadata(Metadata, instances, '', site, language)
+    return instances
+
+
+def prefetch_metadata(objects, name=None):
+    """ Fetches the metadata linked from each of the given objects (eg a
+        list or queryset of objects to be shown in a template) with a query
+        for each content type, so that get_linked_metadata() and
+        {% get_metadata for object %} need no further queries.
+    """
+    Metadata = _get_metadata_model(name)
+    InstanceMetadata = Metadata._meta.get_model('modelinstance')
+    ModelMetadata = Metadata._meta.get_model('model')
+
+    objects_by_type = OrderedDict()
+    for obj in objects:
+        objects_by_type.setdefault(ContentType.objects.get_for_model(obj), []).append(obj)
+
+    for content_type, objs in objects_by_type.items():
+        found = {}
+        if InstanceMetadata is not None:
+            queryset = InstanceMetadata.objects.filter(_content_type=content_type)
+            found = _filter_many(queryset, '_object_id', set(obj.pk for obj in objs))
+        model_md = None
+        if ModelMetadata is not None:
+            model_md = ModelMetadata.objects.filter(_content_type=content_type).first()
+        for obj in objs:
+            instance_md = (found.get(obj.pk) or [None])[0]
+            if not hasattr(obj, '_seo_linked_metadata'):
+                obj._seo_linked_metadata = {}
+            obj._seo_linked_metadata[Metadata._meta.name] = _get_linked_instances(
+                Metadata, obj, content_type, instance_md, model_md)
 
 
 def create_metadata_instance(metadata_class, instance):
@@ -352,12 +688,96 @@ def create_metadata_instance(metadata_class, instance):
         metadata.save()
 
 
-def populate_metadata(model, MetadataClass):
+def populate_metadata(model, MetadataClass, chunk_size=None, progress=None):
     """ For a given model and metadata class, ensure there is metadata for every instance.
+        The instances are streamed in chunks of chunk_size (by default
+        SEO_BULK_CHUNK_SIZE), with a few queries for each chunk: missing
+        metadata is created with bulk_create(), and only instances whose
+        path conflicts with existing metadata are handled one at a time.
+        If given, progress is called after each chunk with the number of
+        instances processed so far and the total number of instances.
     """
+    total = model.objects.count() if progress is not None else None
+    processed = 0
+    for instances, conflicts in _populate_chunks(model, MetadataClass, chunk_size):
+        for instance in conflicts:
+            create_metadata_instance(MetadataClass, instance)
+        processed += len(instances)
+        if progress is not None:
+            progress(processed, total)
+
+
+def _populate_chunks(model, MetadataClass, chunk_size=None, pk_range=None, queryset=None):
+    """ Creates the missing metadata for the instances of the given model
+        (or those in queryset, with a primary key in pk_range, a (first,
+        last) pair, if given), yielding each chunk of instances along with
+        those that could not be handled in bulk, as their paths conflict
+        with other metadata.
+    """
+    chunk_size = chunk_size or SEO_BULK_CHUNK_SIZE
     content_type = ContentType.objects.get_for_model(model)
-    for instance in model.objects.all():
-        create_metadata_instance(MetadataClass, instance)
+    if queryset is None:
+        queryset = model.objects.all()
+    queryset = queryset.order_by('pk')
+    if pk_range is not None:
+        queryset = queryset.filter(pk__gte=pk_range[0], pk__lte=pk_range[1])
+    # Each chunk is fetched after the last primary key of the previous one,
+    # rather than from a single cursor, which would be held open while
+    # writing (and block or break the writes of other processes).
+    instances = list(queryset[:chunk_size])
+    while instances:
+        yield instances, _populate_chunk(MetadataClass, content_type, instances)
+        instances = list(queryset.filter(pk__gt=instances[-1].pk)[:chunk_size])
+
+
+def _populate_chunk(MetadataClass, content_type, instances):
+    """ Creates the missing metadata for the given instances of a model, as
+        create_metadata_instance() would for each of them, and returns the
+        instances that need create_metadata_instance().
+    """
+    paths = OrderedDict()
+    conflicts = []
+    for instance in instances:
+        if getattr(instance, '_site', None) is not None or getattr(instance, '_language', None) is not None:
+            # Paths are looked up on the instance's own site and language
+            conflicts.append(instance)
+            continue
+        try:
+            paths[instance.pk] = instance.get_absolute_url()
+        except AttributeError:
+            pass
+
+    by_object = _filter_many(MetadataClass.objects.filter(_content_type=content_type), '_object_id', paths)
+    by_path = _filter_many(MetadataClass.objects.for_site_and_language(), '_path', set(paths.values()))
+    new = {}
+    for instance in instances:
+        if instance.pk not in paths:
+            continue
+        path = paths[instance.pk]
+        holders = by_path[path]
+        if not holders and not by_object[instance.pk] and path not in new:
+            new[path] = MetadataClass(_content_type=content_type, _object_id=instance.pk, _path=path)
+        elif holders and all(md._content_type_id == content_type.id and md._object_id == instance.pk for md in holders):
+            # This instance already has metadata for its path
+            continue
+        else:
+            conflicts.append(instance)
+
+    if new:
+        MetadataClass.objects.bulk_create(list(new.values()), ignore_conflicts=True)
+        # Another process may have taken some of these paths in the meantime
+        object_ids = [md._object_id for md in new.values()]
+        created = set(MetadataClass.objects.filter(_content_type=content_type, _object_id__in=object_ids)
+                      .values_list('_object_id', flat=True))
+        by_pk = dict((instance.pk, instance) for instance in instances)
+        conflicts.extend(by_pk[md._object_id] for md in new.values() if md._object_id not in created)
+        # No signals are sent, so update any cached metadata for these paths here
+        metadata_class = MetadataClass._metadata
+        if metadata_class._meta.use_cache:
+            caching.invalidate_paths(metadata_class, list(new))
+        if metadata_class._meta.use_head_table:
+            metadata_class._refresh_head_table(list(new))
+    return conflicts
 
 
 def _update_callback(model_class, sender, instance, created, **kwargs):
@@ -370,8 +790,80 @@ def _update_callback(model_class, sender, instance, created, **kwargs):
         then this shouldn't happen.
         I've held it to be more important to avoid double path entries.
     """
+    using = kwargs.get('using')
+    if SEO_UPDATE_ON_COMMIT and transaction.get_connection(using).in_atomic_block:
+        _get_pending_updates(using).add(model_class, sender, instance)
+        return
+
     create_metadata_instance(model_class, instance)
 
+    # The instance may be used in substitutions, so clear its cached metadata
+    if model_class._metadata._meta.use_cache:
+        try:
+            caching.invalidate_paths(model_class._metadata, [instance.get_absolute_url()])
+        except AttributeError:
+            pass
+    if model_class._metadata._meta.use_head_table and hasattr(instance, 'get_absolute_url'):
+        model_class._metadata._refresh_head_table([instance.get_absolute_url()])
+
+
+class _PendingUpdates(object):
+    """ The objects of seo_models saved during a transaction, which are
+        updated together once it is committed, however many times each
+        of them was saved.
+    """
+
+    def __init__(self):
+        self.objects = OrderedDict()
+
+    def add(self, model_class, model, instance):
+        pks = self.objects.setdefault((model_class, model), OrderedDict())
+        # Metadata is only left alone if every save was handled elsewhere (eg by an admin inline)
+        handled = getattr(instance, '_MetadataFormset__seo_metadata_handled', False)
+        pks[instance.pk] = pks.get(instance.pk, True) and handled
+
+    def run(self):
+        objects, self.objects = self.objects, OrderedDict()
+        for (model_class, model), pks in objects.items():
+            _update_many(model_class, model, pks)
+
+
+def _get_pending_updates(using=None):
+    """ Returns the updates pending for the current transaction on the
+        given database, which are run when the transaction is committed.
+    """
+    connection = transaction.get_connection(using)
+    pending = getattr(_pending_local, connection.alias, None)
+    # The callback is discarded if the transaction (or the savepoint it was
+    # registered in) is rolled back, and run once it is committed
+    if pending is None or not any(entry[1] == pending.run for entry in connection.run_on_commit):
+        pending = _PendingUpdates()
+        setattr(_pending_local, connection.alias, pending)
+        transaction.on_commit(pending.run, using=connection.alias)
+    return pending
+
+
+def _update_many(model_class, model, pks):
+    """ Updates the metadata for the objects of the given model with the
+        given primary keys (a dict of whether each one was handled), as
+        _update_callback() would for each of them, in chunks.
+    """
+    metadata_class = model_class._metadata
+    content_type = ContentType.objects.get_for_model(model)
+    for chunk in chunked(pks, SEO_BULK_CHUNK_SIZE):
+        # Objects deleted later in the transaction are simply missing here
+        instances = list(model._base_manager.filter(pk__in=chunk).order_by('pk'))
+        unhandled = [instance for instance in instances if not pks[instance.pk]]
+        for instance in _populate_chunk(model_class, content_type, unhandled):
+            create_metadata_instance(model_class, instance)
+
+        # The instances may be used in substitutions, so clear their cached metadata
+        paths = [instance.get_absolute_url() for instance in instances if hasattr(instance, 'get_absolute_url')]
+        if metadata_class._meta.use_cache:
+            caching.invalidate_paths(metadata_class, paths)
+        if metadata_class._meta.use_head_table:
+            metadata_class._refresh_head_table(paths)
+
 
 def _delete_callback(model_class, sender, instance, **kwargs):
     content_type = ContentType.objects.get_for_model(instance)
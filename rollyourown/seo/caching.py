@@ -0,0 +1,312 @@
+""" Caching of the final metadata output (see Meta.use_cache).
+
+    All of the metadata for a given path is cached as a single record.
+    Records are invalidated when the metadata they were built from changes:
+    a change to a path based backend deletes the records for that path, and
+    any other change renders every record for the metadata definition stale
+    by incrementing its generation counter.
+
+    There is a generation counter for each metadata definition and, when
+    sites are used, for each site. Each record is stamped with the counters
+    it was built under, and these are fetched along with the record, so
+    that any number of records can be invalidated by a single increment,
+    without an extra round trip to the cache.
+
+    Records can also be kept in a small in-process LRU cache, in front of
+    the Django cache, by setting SEO_LOCAL_CACHE_ENTRIES and/or
+    SEO_LOCAL_CACHE_BYTES. The Django cache remains authoritative: local
+    records are only used for SEO_LOCAL_CACHE_TIMEOUT seconds.
+
+    Most paths have no metadata instances at all. For these, only a marker
+    is cached (a record with 'empty' set and no values), recording that
+    there is nothing to look up, so that only the defaults need resolving.
+
+    To avoid a stampede of processes rebuilding a popular record at once,
+    records are kept for SEO_CACHE_STALE_TIMEOUT seconds after they expire
+    (or become stale). The first process to find such a record takes a
+    short lock and rebuilds it, while the others continue to use it.
+"""
+import hashlib
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.utils.encoding import iri_to_uri
+
+from rollyourown.seo.utils import aget_current_site
+
+SEO_LOCAL_CACHE_ENTRIES = getattr(settings, 'SEO_LOCAL_CACHE_ENTRIES', 0)
+SEO_LOCAL_CACHE_BYTES = getattr(settings, 'SEO_LOCAL_CACHE_BYTES', 0)
+SEO_LOCAL_CACHE_TIMEOUT = getattr(settings, 'SEO_LOCAL_CACHE_TIMEOUT', 10)
+SEO_CACHE_TIMEOUT = getattr(settings, 'SEO_CACHE_TIMEOUT', None)
+SEO_CACHE_STALE_TIMEOUT = getattr(settings, 'SEO_CACHE_STALE_TIMEOUT', 60)
+SEO_CACHE_LOCK_TIMEOUT = getattr(settings, 'SEO_CACHE_LOCK_TIMEOUT', 10)
+
+
+class LocalCache(object):
+    """ A thread safe LRU cache held in process memory, bounded by the
+        number of entries and/or their pickled size in bytes.
+        Entries expire after the given timeout (in seconds).
+    """
+
+    def __init__(self, max_entries=0, max_bytes=0, timeout=10):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __bool__(self):
+        return bool(self.max_entries or self.max_bytes)
+    __nonzero__ = __bool__
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, size, expires = self._entries[key]
+            except KeyError:
+                return None
+            if expires < time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)) if self.max_bytes else 0
+        if self.max_bytes and size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, time.time() + self.timeout)
+            self._bytes += size
+            while ((self.max_entries and len(self._entries) > self.max_entries) or
+                   (self.max_bytes and self._bytes > self.max_bytes)):
+                self._remove(next(iter(self._entries)))
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                if key in self._entries:
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        value, size, expires = self._entries.pop(key)
+        self._bytes -= size
+
+local_cache = LocalCache(SEO_LOCAL_CACHE_ENTRIES, SEO_LOCAL_CACHE_BYTES, SEO_LOCAL_CACHE_TIMEOUT)
+
+
+def get_cache_key(metadata_class, path, site=None, language=None):
+    """ Returns the key under which the metadata for the given path is cached. """
+    if metadata_class._meta.use_sites and site:
+        hexpath = hashlib.md5(iri_to_uri(getattr(site, 'domain', site) + path).encode('utf-8')).hexdigest()
+    else:
+        hexpath = hashlib.md5(iri_to_uri(path).encode('utf-8')).hexdigest()
+    if metadata_class._meta.use_i18n:
+        return 'rollyourown.seo.%s.%s.%s' % (metadata_class.__name__, hexpath, language)
+    else:
+        return 'rollyourown.seo.%s.%s' % (metadata_class.__name__, hexpath)
+
+
+def _get_generation_keys(metadata_class, site=None):
+    keys = ['rollyourown.seo.%s.generation' % metadata_class.__name__]
+    if metadata_class._meta.use_sites:
+        keys.append(_get_site_generation_key(site))
+    return keys
+
+
+def _get_site_generation_key(site=None):
+    if not site:
+        site = Site.objects.get_current()
+    return 'rollyourown.seo.site.%s.generation' % iri_to_uri(getattr(site, 'domain', site))
+
+
+def _is_current(record, generation):
+    return record.get('generation') == generation and record.get('expires', float('inf')) >= time.time()
+
+
+def get_record(metadata_class, cache_key, site=None):
+    """ Returns the cached record for the given key and the current
+        generation. The record is None if it is missing, or if it is stale
+        and this process should rebuild it.
+    """
+    records, generation = get_records(metadata_class, [cache_key], site)
+    return records[cache_key], generation
+
+
+def get_records(metadata_class, cache_keys, site=None):
+    """ Returns a dict of the cached record for each of the given keys (see
+        get_record()) and the current generation, using a single get_many().
+    """
+    records = _get_local_records(cache_keys)
+    missing = [key for key in cache_keys if records[key] is None]
+    if not missing:
+        return records, None
+
+    generation_keys = _get_generation_keys(metadata_class, site)
+    values = cache.get_many(missing + generation_keys)
+    generation = tuple(values.get(key, 0) for key in generation_keys)
+    for key in missing:
+        record = records[key] = _check_record(key, values.get(key), generation)
+        if record is not None and not _is_current(record, generation):
+            # Only one process rebuilds a stale record, the others keep using it
+            if cache.add('%s.lock' % key, 1, SEO_CACHE_LOCK_TIMEOUT):
+                records[key] = None
+    return records, generation
+
+
+async def aget_record(metadata_class, cache_key, site=None):
+    """ Async counterpart of get_record(). """
+    records = _get_local_records([cache_key])
+    if records[cache_key] is not None:
+        return records[cache_key], None
+
+    if metadata_class._meta.use_sites and not site:
+        site = await aget_current_site()
+    generation_keys = _get_generation_keys(metadata_class, site)
+    values = await _acache('get_many', [cache_key] + generation_keys)
+    generation = tuple(values.get(key, 0) for key in generation_keys)
+    record = _check_record(cache_key, values.get(cache_key), generation)
+    if record is not None and not _is_current(record, generation):
+        if await _acache('add', '%s.lock' % cache_key, 1, SEO_CACHE_LOCK_TIMEOUT):
+            return None, generation
+    return record, generation
+
+
+def _get_local_records(cache_keys):
+    if local_cache:
+        return dict((key, local_cache.get(key)) for key in cache_keys)
+    return dict((key, None) for key in cache_keys)
+
+
+def _check_record(key, record, generation):
+    """ Returns the given value from the cache if it is a record, keeping
+        it in the local cache if it is current.
+    """
+    if not isinstance(record, dict):
+        return None
+    if local_cache and _is_current(record, generation):
+        local_cache.set(key, record)
+    return record
+
+
+def get_generation(metadata_class, site=None):
+    """ Returns the current generation for records of the given definition and site. """
+    generation_keys = _get_generation_keys(metadata_class, site)
+    values = cache.get_many(generation_keys)
+    return tuple(values.get(key, 0) for key in generation_keys)
+
+
+def _prepare_records(records, generation):
+    timeout = SEO_CACHE_TIMEOUT or cache.default_timeout
+    records = dict((key, {'empty': True} if record['empty'] else dict(record))
+                   for key, record in records.items())
+    for key, record in records.items():
+        record['generation'] = generation
+        if timeout is not None:
+            record['expires'] = time.time() + timeout
+        if local_cache:
+            local_cache.set(key, record)
+    if timeout is not None:
+        timeout += SEO_CACHE_STALE_TIMEOUT
+    return records, timeout
+
+
+def set_records(metadata_class, records, generation):
+    """ Stores the given records (a dict of cache key to record), which
+        were built during the given generation.
+    """
+    records, timeout = _prepare_records(records, generation)
+    if len(records) == 1:
+        cache.set(*list(records.items())[0], timeout=timeout)
+    elif records:
+        cache.set_many(records, timeout=timeout)
+    # Release any locks taken to rebuild these records
+    cache.delete_many(['%s.lock' % key for key in records])
+
+
+async def aset_records(metadata_class, records, generation):
+    """ Async counterpart of set_records(). """
+    records, timeout = _prepare_records(records, generation)
+    if records:
+        await _acache('set_many', records, timeout=timeout)
+    await _acache('delete_many', ['%s.lock' % key for key in records])
+
+
+async def _acache(method, *args, **kwargs):
+    """ Calls the given cache method from an async context, natively where
+        the cache backend supports it.
+    """
+    if hasattr(cache, 'a%s' % method):
+        return await getattr(cache, 'a%s' % method)(*args, **kwargs)
+    from asgiref.sync import sync_to_async
+    return await sync_to_async(getattr(cache, method))(*args, **kwargs)
+
+
+def get_sites_and_languages(metadata_class):
+    """ Returns every (site, language) pair that metadata for a path may be
+        looked up with, including None for the current site and for any language.
+    """
+    sites = [None]
+    if metadata_class._meta.use_sites:
+        sites.extend(Site.objects.all())
+    languages = [None]
+    if metadata_class._meta.use_i18n:
+        languages.extend(code for code, name in settings.LANGUAGES)
+    return [(site, language) for site in sites for language in languages]
+
+
+def invalidate_paths(metadata_class, paths):
+    """ Removes the cached metadata for the given paths, on every site and
+        in every language.
+    """
+    keys = [get_cache_key(metadata_class, path, site, language)
+            for path in paths for site, language in get_sites_and_languages(metadata_class)]
+    cache.delete_many(keys)
+    local_cache.delete_many(keys)
+
+
+def _increment_generation(generation_key):
+    # Other processes will see the change once their local records expire
+    local_cache.clear()
+    try:
+        cache.incr(generation_key)
+    except ValueError:
+        # The counter has been evicted, start again from a value that is
+        # very unlikely to have been used by an existing record.
+        cache.set(generation_key, int(time.time() * 1000), None)
+
+
+def invalidate_metadata(metadata_class):
+    """ Marks all of the cached metadata for the given definition as stale. """
+    _increment_generation(_get_generation_keys(metadata_class)[0])
+
+
+def invalidate_site(site):
+    """ Marks all of the cached metadata for the given site (a Site or a
+        domain) as stale, for every definition that uses sites.
+    """
+    _increment_generation(_get_site_generation_key(site))
+
+
+def _invalidate_callback(backend, sender, instance, **kwargs):
+    """ Callback to be attached to the post_save and post_delete signals
+        of each backend model, removing any affected cached metadata.
+    """
+    paths = backend.get_cached_paths(instance)
+    if paths is None:
+        invalidate_metadata(sender._metadata)
+    elif paths:
+        invalidate_paths(sender._metadata, paths)
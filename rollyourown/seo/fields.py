@@ -5,8 +5,9 @@ import re
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
 from django.utils.html import conditional_escape
+from django.utils.safestring import SafeText
 from django.utils import six
-from rollyourown.seo.utils import escape_tags, NotSet, Literal
+from rollyourown.seo.utils import escape_tags, compile_valid_tags, NotSet, Literal
 
 
 VALID_HEAD_TAGS = "head title base link meta script".split()
@@ -20,6 +21,12 @@ VALID_INLINE_TAGS = (
 ).split()
 
 
+class CleanedValue(SafeText):
+    """ A value that has already been cleaned by its field, such as one
+        stored when the metadata was saved (see Meta.use_prerender).
+    """
+
+
 class MetadataField(object):
     creation_counter = 0
 
@@ -44,7 +51,8 @@ class MetadataField(object):
         if valid_tags is not None:
             valid_tags = set(valid_tags)
         self.valid_tags = valid_tags
-
+        # Compile the sanitizer for this field once, rather than on every clean()
+        self.compiled_valid_tags = compile_valid_tags(self.get_valid_tags())
 
         # Track creation order for field ordering
         self.creation_counter = MetadataField.creation_counter
@@ -81,6 +89,10 @@ class MetadataField(object):
             kwargs.setdefault('verbose_name', self.help_text)
         return self.field(**kwargs)
 
+    def get_valid_tags(self):
+        """ Returns the tags allowed in values of this field. """
+        return self.valid_tags
+
     def clean(self, value):
         return value
 
@@ -102,8 +114,11 @@ class Tag(MetadataField):
         field_kwargs.setdefault('blank', True)
         super(Tag, self).__init__(name, head, editable, populate_from, valid_tags, choices, help_text, verbose_name, field, field_kwargs)
 
+    def get_valid_tags(self):
+        return self.valid_tags or VALID_INLINE_TAGS
+
     def clean(self, value):
-        value = escape_tags(value, self.valid_tags or VALID_INLINE_TAGS)
+        value = escape_tags(value, self.compiled_valid_tags)
 
         return value.strip()
 
@@ -129,7 +144,7 @@ class MetaTag(MetadataField):
         super(MetaTag, self).__init__(name, head, editable, populate_from, valid_tags, choices, help_text, verbose_name, field, field_kwargs)
 
     def clean(self, value):
-        value = escape_tags(value, self.valid_tags)
+        value = escape_tags(value, self.compiled_valid_tags)
 
         # Replace newlines with spaces
         return value.replace("\n", " ").strip()
@@ -151,12 +166,15 @@ class KeywordTag(MetaTag):
                         field_kwargs, help_text)
 
     def clean(self, value):
-        value = escape_tags(value, self.valid_tags)
+        value = escape_tags(value, self.compiled_valid_tags)
 
         # Remove double quote, replace newlines with commas
         return value.replace('"', '&#34;').replace("\n", ", ").strip()
 
 
+BEFORE_TAGS = re.compile("^([^<>]*)<")
+AFTER_TAGS = re.compile(">([^<>]*)$")
+
 # TODO: if max_length is given, use a CharField and pass it through
 class Raw(MetadataField):
     def __init__(self, head=True, editable=True, populate_from=NotSet,
@@ -168,25 +186,24 @@ class Raw(MetadataField):
         field_kwargs.setdefault('blank', True)
         super(Raw, self).__init__(None, head, editable, populate_from, valid_tags, choices, help_text, verbose_name, field, field_kwargs)
 
-    def clean(self, value):
+    def get_valid_tags(self):
         # Find a suitable set of valid tags using self.head and self.valid_tags
         if self.head:
             valid_tags = set(VALID_HEAD_TAGS)
             if self.valid_tags is not None:
                 valid_tags = valid_tags & self.valid_tags
-        else:
-            valid_tags = self.valid_tags
+            return valid_tags
+        return self.valid_tags
 
-        value = escape_tags(value, valid_tags)
+    def clean(self, value):
+        value = escape_tags(value, self.compiled_valid_tags)
 
         if self.head:
             # Remove text before tags
-            before_tags = re.compile("^([^<>]*)<")
-            value = before_tags.sub('<', value)
+            value = BEFORE_TAGS.sub('<', value)
 
             # Remove text after tags
-            after_tags = re.compile(">([^<>]*)$")
-            value = after_tags.sub('>', value)
+            value = AFTER_TAGS.sub('>', value)
 
         return value
 
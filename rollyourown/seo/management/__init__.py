@@ -1,44 +1,225 @@
+import multiprocessing
+from collections import OrderedDict
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connections
 from django.db.models import signals
 from django.db.utils import DatabaseError
+from django.utils import timezone
 from django.contrib.contenttypes.models import ContentType
 
-from rollyourown.seo.base import registry, populate_metadata
-from rollyourown.seo import models as seo_models
+from rollyourown.seo.base import registry, populate_metadata, create_metadata_instance, _populate_chunks
+from rollyourown.seo.backends import SEO_BULK_CHUNK_SIZE
+from rollyourown.seo.utils import chunked
+from rollyourown.seo.models import PopulationCheckpoint
+
+
+SEO_POPULATE_ON_MIGRATE = getattr(settings, 'SEO_POPULATE_ON_MIGRATE', 'defer')
 
 
-def _syncdb_handler(app, created_models, verbosity, **kwargs):
+def _syncdb_handler(app_config, verbosity=1, **kwargs):
+    """ Records that the metadata for models in seo_models that have none
+        yet needs populating, after migrating, for populate_metadata
+        --pending to do outside of the deploy. With SEO_POPULATE_ON_MIGRATE
+        = True, the metadata is populated straight away, and with False
+        nothing is done.
+    """
+    if app_config.name != 'rollyourown.seo' or not SEO_POPULATE_ON_MIGRATE:
+        return
     for Metadata in registry.values():
         InstanceMetadata = Metadata._meta.get_model('modelinstance')
-        if InstanceMetadata is not None and InstanceMetadata in created_models:
+        if InstanceMetadata is not None:
             for model in Metadata._meta.seo_models:
-                content_type = ContentType.objects.get_for_model(model)
-                if InstanceMetadata.objects.filter(_content_type=content_type):
-                    continue
-                if verbosity > 0:
-                        print("Populating %s for %s.%s" % (Metadata._meta.verbose_name_plural, model._meta.app_label, model._meta.object_name))
-
                 try:
                     # If a model is using SEO & it's schema is managed by South migrations rather than syncdb, this call will fail when doing an syncdb for the first time.
-                    populate_metadata(model, InstanceMetadata)
+                    content_type = ContentType.objects.get_for_model(model)
+                    if InstanceMetadata.objects.filter(_content_type=content_type).exists():
+                        continue
+                    if SEO_POPULATE_ON_MIGRATE == 'defer':
+                        if verbosity > 0:
+                            print("Deferring population of %s for %s.%s, run populate_metadata --pending to populate them" % (Metadata._meta.verbose_name_plural, model._meta.app_label, model._meta.object_name))
+                        defer_population(Metadata, model)
+                    else:
+                        if verbosity > 0:
+                            print("Populating %s for %s.%s" % (Metadata._meta.verbose_name_plural, model._meta.app_label, model._meta.object_name))
+                        populate_metadata(model, InstanceMetadata)
                 except DatabaseError as err:
                     print("Database Error (%s) when trying to populate %s for %s.%s. Ignoring (as assumed that this is a migration related issue)" % (str(err), Metadata._meta.verbose_name_plural, model._meta.app_label, model._meta.object_name))
-                    pass
 
 
+def defer_population(Metadata, model):
+    """ Records that the metadata for the given model needs populating, as
+        a run of populate_metadata that has yet to start.
+    """
+    checkpoint, created = PopulationCheckpoint.objects.get_or_create(metadata=Metadata._meta.name, model=model._meta.label)
+    if checkpoint.started is None:
+        checkpoint.started = timezone.now()
+        checkpoint.incremental = False
+        checkpoint.save()
 
-def populate_all_metadata():
+
+def populate_all_metadata(chunk_size=None, progress=None, workers=None, incremental=False, restart=False, pending=False):
     """ Create metadata instances for all models in seo_models if empty.
         Once you have created a single metadata instance, this will not run.
         This is because it is a potentially slow operation that need only be
         done once. If you want to ensure that everything is populated, run the
         populate_metadata management command.
+        If given, progress is called after each chunk of instances with the
+        metadata definition, the model, and the number of instances
+        processed so far out of the total.
+        With more than one worker, the instances are split into ranges of
+        primary keys, which are populated in parallel by a pool of processes.
+
+        Progress is recorded for each model (see PopulationCheckpoint), and
+        an interrupted run is resumed from the last instance populated,
+        unless restart is given. If incremental is given, only instances
+        changed since the last complete run are populated, for models with
+        a timestamp field in SEO_POPULATE_TIMESTAMP_FIELDS. If pending is
+        given, only the runs that are interrupted or deferred (see
+        defer_population()) are carried on.
     """
+    runs = []
     for Metadata in registry.values():
-        InstanceMetadata = Metadata._meta.get_model('modelinstance')
-        if InstanceMetadata is not None:
+        if Metadata._meta.get_model('modelinstance') is not None:
             for model in Metadata._meta.seo_models:
-                populate_metadata(model, InstanceMetadata)
+                if pending and not PopulationCheckpoint.objects.filter(metadata=Metadata._meta.name, model=model._meta.label,
+                                                                       started__isnull=False).exists():
+                    continue
+                runs.append(_start_run(Metadata, model, incremental, restart))
+    if workers is not None and workers > 1:
+        return _populate_all_parallel(runs, workers, chunk_size or SEO_BULK_CHUNK_SIZE, progress)
+
+    for Metadata, model, checkpoint, since in runs:
+        InstanceMetadata = Metadata._meta.get_model('modelinstance')
+        queryset = _get_queryset(model, since, checkpoint.last_pk)
+        total = queryset.count() if progress is not None else None
+        processed = 0
+        for instances, conflicts in _populate_chunks(model, InstanceMetadata, chunk_size, queryset=queryset):
+            for instance in conflicts:
+                create_metadata_instance(InstanceMetadata, instance)
+            processed += len(instances)
+            _save_checkpoint(checkpoint, instances[-1].pk)
+            if progress is not None:
+                progress(Metadata, model, processed, total)
+        _complete_run(checkpoint)
+
+
+SEO_POPULATE_TIMESTAMP_FIELDS = dict((label.lower(), field) for label, field in
+                                     getattr(settings, 'SEO_POPULATE_TIMESTAMP_FIELDS', {}).items())
+
+
+def _start_run(Metadata, model, incremental=False, restart=False):
+    """ Returns the checkpoint for populating the given model, with a run
+        in progress, and the (timestamp field, time) of instances changed
+        since the last complete run, for incremental runs.
+    """
+    checkpoint, created = PopulationCheckpoint.objects.get_or_create(metadata=Metadata._meta.name, model=model._meta.label)
+    if restart or checkpoint.started is None or checkpoint.incremental != incremental:
+        checkpoint.started = timezone.now()
+        checkpoint.last_pk = None
+        checkpoint.incremental = incremental
+        checkpoint.save()
+    since = None
+    field = SEO_POPULATE_TIMESTAMP_FIELDS.get(model._meta.label_lower)
+    if incremental and field and checkpoint.completed is not None:
+        since = (field, checkpoint.completed)
+    return Metadata, model, checkpoint, since
 
 
-signals.post_migrate.connect(_syncdb_handler, sender=seo_models,
+def _get_queryset(model, since=None, last_pk=None):
+    queryset = model.objects.all()
+    if since is not None:
+        queryset = queryset.filter(**{'%s__gte' % since[0]: since[1]})
+    if last_pk is not None:
+        queryset = queryset.filter(pk__gt=last_pk)
+    return queryset
+
+
+def _save_checkpoint(checkpoint, last_pk):
+    checkpoint.last_pk = last_pk
+    checkpoint.save(update_fields=['last_pk'])
+
+
+def _complete_run(checkpoint):
+    checkpoint.completed = checkpoint.started
+    checkpoint.started = None
+    checkpoint.last_pk = None
+    checkpoint.save()
+
+
+signals.post_migrate.connect(_syncdb_handler,
             dispatch_uid="rollyourown.seo.management.populate_metadata")
+
+
+# Each worker process is given this many chunks of instances at a time
+SEO_POPULATE_RANGE_CHUNKS = 10
+
+
+def _populate_all_parallel(runs, workers, chunk_size, progress=None):
+    tasks = []
+    ranges = OrderedDict()
+    for Metadata, model, checkpoint, since in runs:
+        key = (Metadata._meta.name, model._meta.label)
+        ranges[key] = []
+        pks = _get_queryset(model, since, checkpoint.last_pk).order_by('pk').values_list('pk', flat=True).iterator()
+        for chunk in chunked(pks, chunk_size * SEO_POPULATE_RANGE_CHUNKS):
+            tasks.append((key, (chunk[0], chunk[-1]), chunk_size, since))
+            ranges[key].append(len(chunk))
+
+    # The worker processes must not share the connections of this one
+    connections.close_all()
+    runs = dict(((Metadata._meta.name, model._meta.label), (Metadata, model, checkpoint)) for Metadata, model, checkpoint, since in runs)
+    totals = dict((key, sum(counts)) for key, counts in ranges.items())
+    processed = dict((key, 0) for key in ranges)
+    finished = dict((key, {}) for key in ranges)
+    with multiprocessing.Pool(workers, initializer=_init_worker) as pool:
+        for key, pk_range, count, pks in pool.imap_unordered(_populate_range, tasks):
+            Metadata, model, checkpoint = runs[key]
+            processed[key] += count
+            finished[key][pk_range] = pks
+            # Once every range before it is done, resolve the paths that
+            # conflicted (these may involve instances from several workers,
+            # so are resolved here one at a time, in order) and record the progress.
+            while finished[key] and min(finished[key]) == _next_range(tasks, key, checkpoint):
+                pk_range = min(finished[key])
+                InstanceMetadata = Metadata._meta.get_model('modelinstance')
+                for chunk in chunked(sorted(finished[key].pop(pk_range)), chunk_size):
+                    for instance in model.objects.filter(pk__in=chunk).order_by('pk'):
+                        create_metadata_instance(InstanceMetadata, instance)
+                _save_checkpoint(checkpoint, pk_range[1])
+            if progress is not None:
+                progress(Metadata, model, processed[key], totals[key])
+
+    for Metadata, model, checkpoint in runs.values():
+        _complete_run(checkpoint)
+
+
+def _next_range(tasks, key, checkpoint):
+    """ Returns the first range of the given run that is after its checkpoint. """
+    for task_key, pk_range, chunk_size, since in tasks:
+        if task_key == key and (checkpoint.last_pk is None or pk_range[0] > checkpoint.last_pk):
+            return pk_range
+
+
+def _init_worker():
+    # Worker processes that are not forked need Django to be set up
+    if not apps.ready:
+        import django
+        django.setup()
+
+
+def _populate_range(task):
+    """ Populates the metadata for a range of instances in a worker process.
+        Returns the instances processed and those left for the parent
+        process to resolve.
+    """
+    (name, label), pk_range, chunk_size, since = task
+    InstanceMetadata = registry[name]._meta.get_model('modelinstance')
+    model = apps.get_model(label)
+    count = 0
+    conflicts = []
+    for instances, chunk_conflicts in _populate_chunks(model, InstanceMetadata, chunk_size, pk_range, _get_queryset(model, since)):
+        count += len(instances)
+        conflicts.extend(instance.pk for instance in chunk_conflicts)
+    return (name, label), pk_range, count, conflicts
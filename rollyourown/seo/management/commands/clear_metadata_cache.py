@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+
+from django.core.management.base import BaseCommand, CommandError
+from rollyourown.seo.base import registry, invalidate_metadata_cache
+
+class Command(BaseCommand):
+    help = "Mark the cached metadata for the given metadata definitions (or all of them) as stale."
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*',
+                            help="Names of the metadata definitions, all definitions are used by default.")
+        parser.add_argument('--site', dest='site', default=None,
+                            help="Domain of a site, to only clear the cached metadata for that site.")
+
+    def handle(self, *args, **options):
+        names = options['names']
+        if options['site']:
+            if names:
+                raise CommandError("Metadata names cannot be given with --site")
+            invalidate_metadata_cache(site=options['site'])
+        else:
+            for name in names or list(registry.keys()):
+                if name not in registry:
+                    raise CommandError("Metadata definition with name \"%s\" does not exist." % name)
+                invalidate_metadata_cache(name)
@@ -6,9 +6,27 @@ from rollyourown.seo.management import populate_all_metadata
 class Command(BaseCommand):
     help = "Populate the database with metadata instances for all models listed in seo_models."
 
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=None,
+                            help="Number of instances to process at a time (by default SEO_BULK_CHUNK_SIZE).")
+        parser.add_argument('--workers', dest='workers', type=int, default=1,
+                            help="Number of processes to populate the metadata with in parallel.")
+        parser.add_argument('--incremental', dest='incremental', action='store_true', default=False,
+                            help="Only populate instances changed since the last complete run (see SEO_POPULATE_TIMESTAMP_FIELDS).")
+        parser.add_argument('--restart', dest='restart', action='store_true', default=False,
+                            help="Start from the beginning, rather than resuming an interrupted run.")
+        parser.add_argument('--pending', dest='pending', action='store_true', default=False,
+                            help="Only carry on with interrupted runs and those deferred when migrating (see SEO_POPULATE_ON_MIGRATE).")
+
     def handle(self, *args, **options):
         if len(args) > 0:
             raise CommandError("This command currently takes no arguments")
 
-        populate_all_metadata()
+        progress = self.progress if options['verbosity'] > 0 else None
+        populate_all_metadata(options['chunk_size'], progress, options['workers'],
+                              options['incremental'], options['restart'], options['pending'])
+
+    def progress(self, Metadata, model, processed, total):
+        self.stdout.write("Populating %s for %s.%s: %d of %d" % (Metadata._meta.verbose_name_plural,
+                          model._meta.app_label, model._meta.object_name, processed, total))
 
@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+
+from django.core.management.base import BaseCommand, CommandError
+from rollyourown.seo.base import registry, rebuild_head_table
+
+class Command(BaseCommand):
+    help = "Rebuild the head table for the given metadata definitions (or all of those using Meta.use_head_table)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*',
+                            help="Names of the metadata definitions, all definitions using a head table are used by default.")
+
+    def handle(self, *args, **options):
+        names = options['names']
+        for name in names:
+            if name not in registry:
+                raise CommandError("Metadata definition with name \"%s\" does not exist." % name)
+            if not registry[name]._meta.use_head_table:
+                raise CommandError("Metadata definition with name \"%s\" does not use a head table." % name)
+        for name in names or [name for name, Metadata in registry.items() if Metadata._meta.use_head_table]:
+            if options['verbosity'] > 0:
+                self.stdout.write("Rebuilding the head table for %s" % registry[name]._meta.verbose_name_plural)
+            rebuild_head_table(name)
@@ -0,0 +1,96 @@
+""" A table of the final metadata for each path (see Meta.use_head_table).
+
+    Each row holds the cleaned value of every field, each group and the
+    head output for a path (on a site, in a language), keyed by the same
+    key as the cache, so that looking up the metadata for a path is a
+    single primary key lookup. Paths without a row have no metadata
+    instances, so only their defaults are used.
+
+    Rows are rebuilt when the metadata they were built from is saved or
+    deleted, or when an object in seo_models is saved. The whole table can
+    be rebuilt with the rebuild_metadata_heads management command.
+"""
+from django.db import router, transaction
+
+from rollyourown.seo.backends import SEO_BULK_CHUNK_SIZE
+from rollyourown.seo.caching import get_cache_key
+from rollyourown.seo.fields import CleanedValue
+from rollyourown.seo.utils import aget, chunked
+
+
+def get_record(metadata_class, path, site=None, language=None):
+    """ Returns the record for the given path, in the same form as a cached
+        record (see FormattedMetadata._load_cache_record()).
+    """
+    model = metadata_class._meta.head_model
+    try:
+        row = model.objects.get(pk=get_cache_key(metadata_class, path, site, language))
+    except model.DoesNotExist:
+        return {'empty': True}
+    return _get_record(metadata_class, row)
+
+
+def get_records(metadata_class, paths, site=None, language=None):
+    """ Returns a dict of the record for each of the given paths (see
+        get_record()), with a query for each chunk of paths.
+    """
+    model = metadata_class._meta.head_model
+    keys = dict((get_cache_key(metadata_class, path, site, language), path) for path in paths)
+    records = dict((path, {'empty': True}) for path in paths)
+    for chunk in chunked(keys, SEO_BULK_CHUNK_SIZE):
+        for row in model.objects.filter(pk__in=chunk):
+            records[keys[row.pk]] = _get_record(metadata_class, row)
+    return records
+
+
+async def aget_record(metadata_class, path, site=None, language=None):
+    """ Async counterpart of get_record(). """
+    model = metadata_class._meta.head_model
+    try:
+        row = await aget(model.objects.all(), pk=get_cache_key(metadata_class, path, site, language))
+    except model.DoesNotExist:
+        return {'empty': True}
+    return _get_record(metadata_class, row)
+
+
+def _get_record(metadata_class, row):
+    meta = metadata_class._meta
+    values = dict((name, CleanedValue(getattr(row, name))) for name in meta.elements)
+    groups = dict((name, getattr(row, name)) for name in meta.groups)
+    return {'values': values, 'groups': groups, 'head': row._head, 'empty': False}
+
+
+def set_records(metadata_class, paths, records):
+    """ Replaces the rows for the given paths with the given records, a
+        dict of (path, site, language) to record. Paths that have no
+        records are left without rows.
+    """
+    model = metadata_class._meta.head_model
+    elements = metadata_class._meta.elements
+    rows = []
+    for (path, site, language), record in records.items():
+        row = model(_key=get_cache_key(metadata_class, path, site, language), _path=path, _head=record['head'])
+        for name, value in record['values'].items():
+            if value and not isinstance(value, CleanedValue):
+                value = elements[name].clean(value)
+            setattr(row, name, value or '')
+        for name, value in record['groups'].items():
+            setattr(row, name, value)
+        rows.append(row)
+    with transaction.atomic(using=router.db_for_write(model)):
+        model.objects.filter(_path__in=paths).delete()
+        model.objects.bulk_create(rows)
+
+
+def _refresh_callback(backend, sender, instance, **kwargs):
+    """ Callback to be attached to the post_save and post_delete signals
+        of each backend model, rebuilding the rows for any affected paths.
+    """
+    metadata_class = sender._metadata
+    paths = backend.get_cached_paths(instance)
+    if paths is None:
+        # Model metadata is used by every model instance of its content type
+        InstanceMetadata = metadata_class._meta.get_model('modelinstance')
+        paths = InstanceMetadata.objects.filter(_content_type=instance._content_type_id)
+        paths = paths.values_list('_path', flat=True).order_by('pk').iterator()
+    metadata_class._refresh_head_table(paths)
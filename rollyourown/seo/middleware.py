@@ -0,0 +1,51 @@
+import asyncio
+
+try:
+    from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+except ImportError:
+    iscoroutinefunction = asyncio.iscoroutinefunction
+
+    def markcoroutinefunction(func):
+        func._is_coroutine = asyncio.coroutines._is_coroutine
+        return func
+
+from rollyourown.seo.base import start_request_memo, end_request_memo, set_request_view
+
+
+class MetadataMiddleware(object):
+    """ Memoizes metadata for the duration of each request, so that
+        repeated {% get_metadata %} calls for the same metadata, path,
+        site and language only look up the metadata once.
+        Metadata fetched in an async view with aget_metadata() is memoized
+        in the same way. The view that the request resolved to is also
+        remembered, so that view metadata can be found without resolving
+        the path again.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self._async = iscoroutinefunction(get_response)
+        if self._async:
+            # Let Django know that this instance should be awaited
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self._async:
+            return self.__acall__(request)
+        previous = start_request_memo()
+        try:
+            return self.get_response(request)
+        finally:
+            end_request_memo(previous)
+
+    async def __acall__(self, request):
+        previous = start_request_memo()
+        try:
+            return await self.get_response(request)
+        finally:
+            end_request_memo(previous)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        set_request_view(request.path, getattr(request, 'resolver_match', None))
@@ -1,4 +1,24 @@
 #!/usr/bin/env python
+from django.db import models
+
+
+class PopulationCheckpoint(models.Model):
+    """ The progress of populate_metadata for a metadata definition and a
+        model, so that an interrupted run can be resumed, and incremental
+        runs need only look at instances changed since the last one.
+    """
+    metadata = models.CharField(max_length=255)
+    model = models.CharField(max_length=255)
+    incremental = models.BooleanField(default=False)
+    # The run in progress: when it started and the last instance populated
+    started = models.DateTimeField(null=True)
+    last_pk = models.BigIntegerField(null=True)
+    # When the last complete run started
+    completed = models.DateTimeField(null=True)
+
+    class Meta:
+        app_label = 'seo'
+        unique_together = (('metadata', 'model'),)
 
 
 def setup():
@@ -7,6 +7,12 @@ except ImportError:
     from django.utils.text import camel_case_to_spaces as get_verbose_name
 from django.db import models
 from django.apps import apps
+from django.utils.functional import curry
+from django.utils.translation import ugettext_lazy as _
+
+from rollyourown.seo.caching import _invalidate_callback
+from rollyourown.seo.materialized import _refresh_callback
+from rollyourown.seo.backends import SEO_PATH_FIELD_MAX_LENGTH
 
 class Options(object):
     def __init__(self, meta, help_text=None):
@@ -14,6 +20,8 @@ class Options(object):
         self.use_i18n = meta.pop('use_i18n', False)
         self.use_redirect = meta.pop('use_redirect', False)
         self.use_cache = meta.pop('use_cache', False)
+        self.use_prerender = meta.pop('use_prerender', False)
+        self.use_head_table = meta.pop('use_head_table', False)
         self.groups = meta.pop('groups', {})
         self.seo_views = meta.pop('seo_views', [])
         self.verbose_name = meta.pop('verbose_name', None)
@@ -25,6 +33,10 @@ class Options(object):
         self.models = OrderedDict()
         self.name = None
         self.elements = None
+        self.head_plan = ()
+        self.group_plans = {}
+        self.prerendered = {}
+        self.head_model = None
         self.metadata = None
 
     def get_model(self, name):
@@ -46,6 +58,12 @@ class Options(object):
         for key, obj in elements.items():
             obj.contribute_to_class(self.metadata, key)
 
+        # Compile the plan for rendering the head and each group, a tuple of
+        # (name, clean, render) for each field, so that rendering need only run it.
+        self.head_plan = tuple((key, obj.clean, obj.render) for key, obj in elements.items() if obj.head)
+        self.group_plans = dict((name, tuple((key, elements[key].clean, elements[key].render) for key in members))
+                                for name, members in self.groups.items())
+
         # Create the common Django fields
         fields = {}
         for key, obj in elements.items():
@@ -56,6 +74,12 @@ class Options(object):
                         field.help_text = self.bulk_help_text[key]
                 fields[key] = field
 
+        # Each editable field gets a column for its cleaned value, see MetadataBaseModel.save()
+        if self.use_prerender:
+            self.prerendered = OrderedDict((key, '_%s_html' % key) for key, obj in elements.items() if obj.editable)
+            for key, attname in self.prerendered.items():
+                fields[attname] = models.TextField(null=True, editable=False)
+
         # 0. Abstract base model with common fields
         base_meta = type('Meta', (), self.original_meta)
         class BaseMeta(base_meta):
@@ -69,7 +93,8 @@ class Options(object):
     def _add_backend(self, backend):
         """ Builds a subclass model for the given backend """
         md_type = backend.verbose_name
-        base = backend().get_model(self)
+        backend = backend()
+        base = backend.get_model(self)
         # TODO: Rename this field
         new_md_attrs = {'_metadata': self.metadata, '__module__': __name__ }
 
@@ -84,6 +109,40 @@ class Options(object):
         # This is a little dangerous, but because we set __module__ to __name__, the model needs tobe accessible here
         globals()[model.__name__] = model
 
+        # Remove cached metadata when the metadata changes
+        if self.use_cache:
+            invalidate_callback = curry(_invalidate_callback, backend=backend)
+            models.signals.post_save.connect(invalidate_callback, sender=model, weak=False)
+            models.signals.post_delete.connect(invalidate_callback, sender=model, weak=False)
+
+        # Rebuild the head table when the metadata changes
+        if self.use_head_table:
+            refresh_callback = curry(_refresh_callback, backend=backend)
+            models.signals.post_save.connect(refresh_callback, sender=model, weak=False)
+            models.signals.post_delete.connect(refresh_callback, sender=model, weak=False)
+
+    def _add_head_model(self):
+        """ Builds the model for the head table (see Meta.use_head_table),
+            with the final value of each field and group for each path.
+        """
+        if 'view' in self.backends:
+            raise Exception("Meta.use_head_table cannot be used with the 'view' backend, "
+                            "as the metadata for views depends on the view context")
+        attrs = {'__module__': __name__}
+        attrs['_key'] = models.CharField(max_length=255, primary_key=True)
+        attrs['_path'] = models.CharField(_('path'), max_length=SEO_PATH_FIELD_MAX_LENGTH, db_index=True)
+        attrs['_head'] = models.TextField(default="", blank=True)
+        for key in list(self.elements) + list(self.groups):
+            attrs[key] = models.TextField(default="", blank=True)
+
+        head_meta = {}
+        head_meta['app_label'] = 'seo'
+        head_meta['verbose_name'] = '%s (%s)' % (self.verbose_name, 'Head')
+        head_meta['verbose_name_plural'] = '%s (%s)' % (self.verbose_name_plural, 'Head')
+        attrs['Meta'] = type("Meta", (), head_meta)
+        self.head_model = type("%sHead" % self.name, (models.Model,), attrs)
+        globals()[self.head_model.__name__] = self.head_model
+
     def _set_seo_models(self, value):
         """ Gets the actual models to be used. """
         seo_models = []
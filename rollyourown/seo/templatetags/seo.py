@@ -12,6 +12,8 @@ class MetadataNode(template.Node):
         self.metadata_name = metadata_name
         self.variable_name = variable_name
         self.target = template.Variable(target or 'request.path')
+        # Without an explicit target, the current request has already been resolved
+        self.use_resolver_match = not target
         self.site = site and template.Variable(site) or None
         self.language = language and template.Variable(language) or None
 
@@ -52,6 +54,8 @@ class MetadataNode(template.Node):
         if not isinstance(path, six.string_types):
             path = None
         if not metadata:
+            if self.use_resolver_match:
+                kwargs['view_name'] = getattr(context.get('request'), 'resolver_match', None)
             # Fetch the metadata
             try:
                 metadata = get_metadata(path, self.metadata_name, context, **kwargs)
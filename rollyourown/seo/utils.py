@@ -1,12 +1,15 @@
 import logging
 import re
+from functools import lru_cache
 
 from django.conf import settings
 from django.db import models
 from django.utils.functional import lazy
-from django.utils.safestring import mark_safe
-from django.utils.html import conditional_escape
+from django.utils import six
+from django.utils.safestring import mark_safe, SafeData
+from django.utils.html import escape
 from django.contrib.contenttypes.models import ContentType
+from django.contrib.sites.models import Site
 
 
 class NotSet(object):
@@ -90,20 +93,24 @@ class LazyChoices(LazyList):
             return bool(len(self))
 
 
-from django.urls import URLResolver, Resolver404, get_resolver
+from django.urls import URLResolver, get_resolver
 from django.urls.resolvers import URLPattern
+from django.utils.translation import get_language
+
+SEO_RESOLVE_CACHE_SIZE = getattr(settings, 'SEO_RESOLVE_CACHE_SIZE', 1000)
 
-def _pattern_resolve_to_name(pattern, path):
-    match = get_regex(pattern).search(path)
-    if match:
-        name = ""
-        if pattern.name:
-            name = pattern.name
-        elif hasattr(pattern, '_callback_str'):
-            name = pattern._callback_str
-        else:
-            name = "%s.%s" % (pattern.callback.__module__, pattern.callback.__name__)
-        return name
+
+def _get_pattern_name(pattern):
+    if pattern.name:
+        return pattern.name
+    elif hasattr(pattern, '_callback_str'):
+        return pattern._callback_str
+    else:
+        callback = pattern.callback
+        if not hasattr(callback, '__name__'):
+            # A callable instance or a partial, named as ResolverMatch does
+            callback = callback.__class__
+        return "%s.%s" % (callback.__module__, callback.__name__)
 
 def get_regex(resolver_or_pattern):
      """Utility method for django's deprecated resolver.regex"""
@@ -113,42 +120,105 @@ def get_regex(resolver_or_pattern):
          regex = resolver_or_pattern.pattern.regex
      return regex
 
-def _resolver_resolve_to_name(resolver, path):
-    tried = []
-    match = get_regex(resolver).search(path)
+def _get_search(resolver_or_pattern):
+    """ Returns a function to search a path with the regex of the given
+        resolver or pattern, compiling it now unless it depends on the
+        active language (eg i18n_patterns or translated regexes).
+    """
+    pattern = getattr(resolver_or_pattern, 'pattern', None)
+    source = getattr(pattern, '_regex', getattr(pattern, '_route', None))
+    if pattern is None or isinstance(source, six.string_types):
+        return get_regex(resolver_or_pattern).search
+    return lambda path: get_regex(resolver_or_pattern).search(path)
+
+def _get_index(resolver_or_pattern):
+    """ Returns a tree of (search, target) tuples for the given resolver
+        (where target is a tuple of the same for each of its patterns) or
+        pattern (where target is the pattern itself, named when matched).
+    """
+    if isinstance(resolver_or_pattern, URLResolver):
+        children = []
+        for pattern in resolver_or_pattern.url_patterns:
+            if isinstance(pattern, (URLResolver, URLPattern)):
+                children.append(_get_index(pattern))
+        return _get_search(resolver_or_pattern), tuple(children)
+    return _get_search(resolver_or_pattern), resolver_or_pattern
+
+# Indexes are built once for each resolver, ie for each urlconf until the
+# url caches are cleared (see django.urls.clear_url_caches)
+_get_resolver_index = lru_cache(maxsize=16)(_get_index)
+
+def _search_index(index, path):
+    search, target = index
+    match = search(path)
     if match:
-        new_path = path[match.end():]
-        for pattern in resolver.url_patterns:
-            try:
-                if isinstance(pattern, URLResolver):
-                    name = _resolver_resolve_to_name(pattern, new_path)
-                elif isinstance(pattern, URLPattern):
-                    name = _pattern_resolve_to_name(pattern, new_path)
-            except Resolver404 as e:
-                tried.extend([(get_regex(pattern).pattern + '   ' + t) for t in e.args[0]['tried']])
-            else:
-                if name:
-                    return name
-                tried.append(get_regex(pattern).pattern)
-        raise Resolver404({'tried': tried, 'path': new_path})
+        if not isinstance(target, tuple):
+            return _get_pattern_name(target)
+        path = path[match.end():]
+        for child in target:
+            name = _search_index(child, path)
+            if name:
+                return name
+    return None
+
+@lru_cache(maxsize=SEO_RESOLVE_CACHE_SIZE)
+def _resolve_to_name(resolver, path, language):
+    return _search_index(_get_resolver_index(resolver), path)
 
 
 def resolve_to_name(path, urlconf=None):
-    try:
-        return _resolver_resolve_to_name(get_resolver(urlconf), path)
-    except Resolver404:
-        return None
+    """ Returns the name of the view for the given path (or None).
+        Recently resolved paths are remembered, up to SEO_RESOLVE_CACHE_SIZE.
+    """
+    return _resolve_to_name(get_resolver(urlconf), path, get_language())
+
+
+def get_view_name(view_name):
+    """ Returns the view name (as returned by resolve_to_name) for the given
+        ResolverMatch, or the given name itself.
+    """
+    if hasattr(view_name, 'url_name'):
+        return view_name.url_name or view_name._func_path
+    return view_name
+
+
+# Escapes for text outside of valid tags, as conditional_escape() would give
+_TEXT_ESCAPES = dict((ord(c), six.text_type(escape(c))) for c in '&<>"\'')
+# Inside valid tags, only '<' (other than in comments) and "'" are escaped
+_TAG_ESCAPES_RE = re.compile(r"<(?!!--)|'")
+
+
+def _escape_tag_char(match):
+    return _TEXT_ESCAPES[ord(match.group())]
+
+
+@lru_cache(maxsize=128)
+def _compile_valid_tags(valid_tags):
+    # A valid tag runs until the first '>' (not crossing lines, except for
+    # trailing whitespace). Comment markers are left alone.
+    tokens = [r'<!(?=--)', r'-->']
+    if valid_tags:
+        names = '|'.join(re.escape(tag) for tag in sorted(valid_tags))
+        tokens.insert(0, r'<(?P<tag>\s*/?\s*(?:%s)[^\n>]*\s*)>' % names)
+    return re.compile('|'.join(tokens))
 
 
-def _replace_quot(match):
-    unescape = lambda v: v.replace('&quot;', '"').replace('&amp;', '&')
-    return '<%s%s>' % (unescape(match.group(1)), unescape(match.group(3)))
+def compile_valid_tags(valid_tags):
+    """ Returns the compiled sanitizer for the given valid tags, for use
+        with escape_tags(). These are cached for each set of tags.
+    """
+    if hasattr(valid_tags, 'finditer'):
+        return valid_tags
+    return _compile_valid_tags(frozenset(valid_tags or ()))
 
 
 def escape_tags(value, valid_tags):
-    """ Strips text from the given html string, leaving only tags.
-        This functionality requires BeautifulSoup, nothing will be
-        done otherwise.
+    """ Escapes the given html string, leaving only valid tags (and comments).
+        This is done in a single pass: the text between valid tags is escaped
+        and the tags themselves are copied through.
+        Values that are already safe (eg rendered templates) are left alone.
+
+        valid_tags may be a list of tags, or the result of compile_valid_tags().
 
         This isn't perfect. Someone could put javascript in here:
               <a onClick="alert('hi');">test</a>
@@ -159,19 +229,20 @@ def escape_tags(value, valid_tags):
               - use BeautifulSoup to understand the elements, escape everything else and remove potentially harmful attributes (onClick).
               - Remove this feature entirely. Half-escaping things securely is very difficult, developers should not be lured into a false sense of security.
     """
-    # 1. escape everything
-    value = conditional_escape(value)
-
-    # 2. Reenable certain tags
-    if valid_tags:
-        # TODO: precompile somewhere once?
-        tag_re = re.compile(r'&lt;(\s*/?\s*(%s))(.*?\s*)&gt;' % '|'.join(re.escape(tag) for tag in valid_tags))
-        value = tag_re.sub(_replace_quot, value)
-
-    # Allow comments to be hidden
-    value = value.replace("&lt;!--", "<!--").replace("--&gt;", "-->")
-
-    return mark_safe(value)
+    if isinstance(value, SafeData):
+        return value
+    value = six.text_type(value)
+    output = []
+    position = 0
+    for match in compile_valid_tags(valid_tags).finditer(value):
+        output.append(value[position:match.start()].translate(_TEXT_ESCAPES))
+        if match.lastgroup == 'tag':
+            output.append('<%s>' % _TAG_ESCAPES_RE.sub(_escape_tag_char, match.group('tag')))
+        else:
+            output.append(match.group())
+        position = match.end()
+    output.append(value[position:].translate(_TEXT_ESCAPES))
+    return mark_safe(''.join(output))
 
 
 def _get_seo_content_types(seo_models):
@@ -184,3 +255,55 @@ def _get_seo_content_types(seo_models):
 
 def get_seo_content_types(seo_models):
     return lazy(_get_seo_content_types, list)(seo_models)
+
+
+def chunked(iterable, size):
+    """ Yields lists of up to size items from the given iterable, so that
+        large querysets (using iterator()) can be processed in bounded memory.
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+async def call_async(func, *args, **kwargs):
+    """ Calls the given blocking function in a thread, from an async context. """
+    from asgiref.sync import sync_to_async
+    return await sync_to_async(func)(*args, **kwargs)
+
+
+async def aget_current_site():
+    """ Async counterpart of Site.objects.get_current(). """
+    return await call_async(Site.objects.get_current)
+
+
+async def aget_content_type(model=None, id=None):
+    """ Async counterpart of ContentType.objects.get_for_model() (or of
+        get_for_id(), if id is given).
+    """
+    if id is not None:
+        return await call_async(ContentType.objects.get_for_id, id)
+    return await call_async(ContentType.objects.get_for_model, model)
+
+
+async def alist(queryset):
+    """ Evaluates the given queryset from an async context, natively where
+        Django supports it.
+    """
+    if hasattr(queryset, '__aiter__'):
+        return [obj async for obj in queryset]
+    from asgiref.sync import sync_to_async
+    return await sync_to_async(list)(queryset)
+
+
+async def aget(queryset, **kwargs):
+    """ Async counterpart of queryset.get() """
+    if hasattr(queryset, 'aget'):
+        return await queryset.aget(**kwargs)
+    from asgiref.sync import sync_to_async
+    return await sync_to_async(queryset.get)(**kwargs)